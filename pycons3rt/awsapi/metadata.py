@@ -7,11 +7,17 @@ meta data service.
 
 """
 import logging
-import urllib
 import sys
 import time
 
-import netifaces
+import requests
+from requests.adapters import HTTPAdapter
+
+# netifaces is only needed where sysfs is not available
+try:
+    import netifaces
+except ImportError:
+    netifaces = None
 
 # Pass ImportError on boto3 for offline assets
 try:
@@ -34,6 +40,38 @@ mod_logger = Logify.get_name() + '.awsapi.metadata'
 # AWS Meta Data Service URL
 metadata_url = 'http://169.254.169.254/latest/meta-data/'
 
+# AWS Instance Identity Document URL
+identity_document_url = 'http://169.254.169.254/latest/dynamic/instance-identity/document'
+
+# AWS Meta Data Service (IMDSv2) session token URL and token lifetime
+token_url = 'http://169.254.169.254/latest/api/token'
+token_ttl_sec = 21600
+
+# Cached result of is_aws(), None until the meta data service has been probed
+_is_aws_cached = None
+
+# Cache of meta data values that do not change for the life of the instance
+_metadata_cache = {}
+
+# Shared HTTP session so meta data queries re-use a single keep-alive
+# connection to the meta data service
+_imds_session = requests.Session()
+
+# The meta data service is link-local, never route it through a proxy
+_imds_session.trust_env = False
+
+# Single host urllib3 connection pool, re-tries are handled by _imds_get
+_imds_session.mount('http://', HTTPAdapter(pool_connections=1, pool_maxsize=4, max_retries=0))
+
+# Connect and read timeouts for meta data service queries
+imds_timeout_sec = (0.2, 1.0)
+
+# Cached IMDSv2 session token and the time it expires
+_imds_token = {
+    'token': None,
+    'expires': 0
+}
+
 
 class AWSMetaDataError(Exception):
     """Simple exception type for AWS meta data service errors
@@ -41,42 +79,219 @@ class AWSMetaDataError(Exception):
     pass
 
 
+def reset_aws_cache():
+    """Clears the cached is_aws() result so the next call probes the
+    AWS meta data service again
+
+    :return: None
+    """
+    global _is_aws_cached
+    _is_aws_cached = None
+
+
+def clear_metadata_cache():
+    """Clears the cached meta data values so they are queried again
+
+    :return: None
+    """
+    _metadata_cache.clear()
+
+
+def _get_imds_token():
+    """Gets an IMDSv2 session token, a new token is only requested
+    when the cached token is about to expire
+
+    :return: (str) IMDSv2 token or None if only IMDSv1 is available
+    """
+    log = logging.getLogger(mod_logger + '._get_imds_token')
+    now = time.time()
+    if now < _imds_token['expires']:
+        return _imds_token['token']
+    try:
+        response = _imds_session.put(token_url, timeout=imds_timeout_sec,
+                                     headers={'X-aws-ec2-metadata-token-ttl-seconds': str(token_ttl_sec)})
+    except(IOError, OSError, requests.exceptions.RequestException) as ex:
+        log.debug('Unable to get an IMDSv2 token, falling back to IMDSv1: %s', ex)
+        response = None
+    if response is not None and response.status_code == 200:
+        _imds_token['token'] = response.content
+        # Renew the token a minute before it actually expires
+        _imds_token['expires'] = now + token_ttl_sec - 60
+    else:
+        # Try again in a minute rather than on every query
+        _imds_token['token'] = None
+        _imds_token['expires'] = now + 60
+    return _imds_token['token']
+
+
+def _imds_headers():
+    """Returns the headers to send with meta data service queries
+
+    :return: (dict) HTTP headers
+    """
+    token = _get_imds_token()
+    if token is None:
+        return {}
+    return {'X-aws-ec2-metadata-token': token}
+
+
+def _imds_get(url, max_tries=3, base_delay_sec=0.1, max_delay_sec=10.0):
+    """Queries a meta data service URL, re-trying with exponential
+    backoff on connection errors and HTTP 500/503 responses
+
+    :param url: (str) meta data service URL
+    :param max_tries: (int) maximum number of attempts
+    :param base_delay_sec: (float) wait before the first re-try, doubled
+        for each re-try after that
+    :param max_delay_sec: (float) maximum wait between attempts
+    :return: requests.Response from the last attempt
+    :raises: AWSMetaDataError
+    """
+    log = logging.getLogger(mod_logger + '._imds_get')
+    attempt_num = 1
+    while True:
+        try:
+            response = _imds_session.get(url, timeout=imds_timeout_sec, headers=_imds_headers())
+        except(IOError, OSError, requests.exceptions.RequestException):
+            _, ex, trace = sys.exc_info()
+            if attempt_num >= max_tries:
+                msg = 'Unable to query meta data URL {u} after {n} attempts\n{e}'.format(
+                    u=url, n=attempt_num, e=str(ex))
+                raise AWSMetaDataError, msg, trace
+            log.debug('Query of meta data URL %s failed on attempt %s of %s: %s', url, attempt_num, max_tries, ex)
+        else:
+            if response.status_code == 401:
+                # The IMDSv2 token was rejected, request a new one before re-trying
+                _imds_token['expires'] = 0
+            elif response.status_code not in (500, 503):
+                return response
+            if attempt_num >= max_tries:
+                return response
+            log.debug('Meta data URL %s returned code %s on attempt %s of %s',
+                      url, response.status_code, attempt_num, max_tries)
+        time.sleep(min(max_delay_sec, base_delay_sec * 2 ** (attempt_num - 1)))
+        attempt_num += 1
+
+
+def _read_system_file(file_path):
+    """Reads a small system file such as DMI data from sysfs
+
+    :param file_path: (str) Full path to the file
+    :return: (str) stripped file contents or None if unreadable
+    """
+    try:
+        with open(file_path, 'r') as f:
+            return f.read().strip()
+    except (IOError, OSError):
+        return
+
+
+def _dmi_is_aws():
+    """Checks the hypervisor UUID and DMI data for signs of EC2
+
+    Xen based instances have a hypervisor UUID starting with ec2,
+    Nitro based instances report Amazon EC2 as the system and BIOS
+    vendor.
+
+    :return: (bool) True if EC2 is indicated, False if DMI data is
+        readable and does not indicate EC2, None if undetermined
+    """
+    for uuid_file in ['/sys/hypervisor/uuid', '/sys/devices/virtual/dmi/id/product_uuid']:
+        uuid = _read_system_file(uuid_file)
+        if uuid and uuid.lower().startswith('ec2'):
+            return True
+    sys_vendor = _read_system_file('/sys/devices/virtual/dmi/id/sys_vendor')
+    for dmi_value in [sys_vendor,
+                      _read_system_file('/sys/devices/virtual/dmi/id/bios_vendor'),
+                      _read_system_file('/sys/devices/virtual/dmi/id/bios_version')]:
+        if dmi_value and 'amazon' in dmi_value.lower():
+            return True
+    if sys_vendor is None:
+        return
+    return False
+
+
 def is_aws():
     """Determines if this system is on AWS
 
+    The meta data service is probed at most once per process, the
+    result is cached for subsequent calls.
+
     :return: bool True if this system is running on AWS
     """
+    global _is_aws_cached
+    if _is_aws_cached is not None:
+        return _is_aws_cached
+
     log = logging.getLogger(mod_logger + '.is_aws')
-    log.info('Querying AWS meta data URL: {u}'.format(u=metadata_url))
 
-    # Re-try logic for checking the AWS meta data URL
-    retry_time_sec = 10
-    max_num_tries = 10
-    attempt_num = 1
+    # Skip the meta data service when local DMI data shows this is not EC2
+    if _dmi_is_aws() is False:
+        log.info('DMI data does not indicate EC2, this system is NOT running on AWS')
+        _is_aws_cached = False
+        return False
 
-    while True:
-        if attempt_num > max_num_tries:
-            log.info('Unable to query the AWS meta data URL, this system is NOT running on AWS\n{e}')
-            return False
+    log.info('Querying AWS meta data URL: %s', metadata_url)
+
+    # Query the AWS meta data URL, re-trying while networking may still be coming up
+    try:
+        response = _imds_get(metadata_url, max_tries=10)
+    except AWSMetaDataError as ex:
+        log.info('Unable to query the AWS meta data URL, this system is NOT running on AWS\n%s', ex)
+        _is_aws_cached = False
+        return False
+
+    # Check the code
+    if response.status_code == 200:
+        log.info('AWS metadata service returned code 200, this system is running on AWS')
+        _is_aws_cached = True
+    else:
+        log.info('AWS metadata service returned code: %s, this system is NOT running on AWS', response.status_code)
+        _is_aws_cached = False
+    return _is_aws_cached
+
+
+def _fetch_identity_document():
+    """Gets the instance identity document, which provides the
+    instanceId, region, availabilityZone, accountId and other
+    identifiers in a single meta data service query
 
-        # Query the AWS meta data URL
+    :return: (dict) instance identity document or None
+    """
+    log = logging.getLogger(mod_logger + '._fetch_identity_document')
+
+    if 'identity-document' not in _metadata_cache:
+        if not is_aws():
+            log.info('This machine is not running in AWS, exiting...')
+            return
         try:
-            response = urllib.urlopen(metadata_url)
-        except(IOError, OSError) as ex:
-            log.warn('Failed to query the AWS meta data URL\n{e}'.format(e=str(ex)))
-            attempt_num += 1
-            time.sleep(retry_time_sec)
-            continue
-
-        # Check the code
-        if response.getcode() == 200:
-            log.info('AWS metadata service returned code 200, this system is running on AWS')
-            return True
-        else:
-            log.warn('AWS metadata service returned code: {c}'.format(c=response.getcode()))
-            attempt_num += 1
-            time.sleep(retry_time_sec)
-            continue
+            response = _imds_get(identity_document_url)
+        except AWSMetaDataError as ex:
+            log.warn('Unable to query URL to get the instance identity document: {u}\n{e}'.format(
+                u=identity_document_url, e=ex))
+            return
+        if response.status_code != 200:
+            log.warn('There was a problem querying url: {u}, returned code: {c}, unable to get the instance '
+                     'identity document'.format(u=identity_document_url, c=response.status_code))
+            return
+        try:
+            _metadata_cache['identity-document'] = response.json()
+        except ValueError as ex:
+            log.warn('Unable to parse the instance identity document: {e}'.format(e=ex))
+            return
+    return _metadata_cache['identity-document']
+
+
+def _get_identity_document_value(key):
+    """Gets a single value from the instance identity document
+
+    :param key: (str) identity document key (e.g. instanceId)
+    :return: (str) value or None if the document or key is unavailable
+    """
+    identity_document = _fetch_identity_document()
+    if not identity_document or not identity_document.get(key):
+        return
+    return str(identity_document[key])
 
 
 def get_instance_id():
@@ -86,27 +301,37 @@ def get_instance_id():
     """
     log = logging.getLogger(mod_logger + '.get_instance_id')
 
+    if 'instance-id' in _metadata_cache:
+        return _metadata_cache['instance-id']
+
     # Exit if not running on AWS
     if not is_aws():
         log.info('This machine is not running in AWS, exiting...')
         return
 
+    # Use the instance identity document when available
+    instance_id = _get_identity_document_value('instanceId')
+    if instance_id:
+        _metadata_cache['instance-id'] = instance_id
+        return instance_id
+
     instance_id_url = metadata_url + 'instance-id'
     try:
-        response = urllib.urlopen(instance_id_url)
-    except(IOError, OSError) as ex:
+        response = _imds_get(instance_id_url)
+    except AWSMetaDataError as ex:
         msg = 'Unable to query URL to get instance ID: {u}\n{e}'. \
             format(u=instance_id_url, e=ex)
         log.error(msg)
         return
 
     # Check the code
-    if response.getcode() != 200:
+    if response.status_code != 200:
         msg = 'There was a problem querying url: {u}, returned code: {c}, unable to get the instance-id'.format(
-                u=instance_id_url, c=response.getcode())
+                u=instance_id_url, c=response.status_code)
         log.error(msg)
         return
-    instance_id = response.read()
+    instance_id = response.content
+    _metadata_cache['instance-id'] = instance_id
     return instance_id
 
 
@@ -117,6 +342,9 @@ def get_vpc_id_from_mac_address():
     """
     log = logging.getLogger(mod_logger + '.get_vpc_id')
 
+    if 'vpc-id' in _metadata_cache:
+        return _metadata_cache['vpc-id']
+
     # Exit if not running on AWS
     if not is_aws():
         log.info('This machine is not running in AWS, exiting...')
@@ -135,19 +363,20 @@ def get_vpc_id_from_mac_address():
 
     vpc_id_url = metadata_url + 'network/interfaces/macs/' + mac_address + '/vpc-id'
     try:
-        response = urllib.urlopen(vpc_id_url)
-    except(IOError, OSError) as ex:
+        response = _imds_get(vpc_id_url)
+    except AWSMetaDataError as ex:
         msg = 'Unable to query URL to get VPC ID: {u}\n{e}'.format(u=vpc_id_url, e=ex)
         log.error(msg)
         return
 
     # Check the code
-    if response.getcode() != 200:
+    if response.status_code != 200:
         msg = 'There was a problem querying url: {u}, returned code: {c}, unable to get the vpc-id'.format(
-                u=vpc_id_url, c=response.getcode())
+                u=vpc_id_url, c=response.status_code)
         log.error(msg)
         return
-    vpc_id = response.read()
+    vpc_id = response.content
+    _metadata_cache['vpc-id'] = vpc_id
     return vpc_id
 
 
@@ -158,11 +387,20 @@ def get_owner_id_from_mac_address():
     """
     log = logging.getLogger(mod_logger + '.get_owner_id')
 
+    if 'owner-id' in _metadata_cache:
+        return _metadata_cache['owner-id']
+
     # Exit if not running on AWS
     if not is_aws():
         log.info('This machine is not running in AWS, exiting...')
         return
 
+    # The owner ID is the account ID from the instance identity document
+    owner_id = _get_identity_document_value('accountId')
+    if owner_id:
+        _metadata_cache['owner-id'] = owner_id
+        return owner_id
+
     # Get the primary interface MAC address to query the meta data service
     log.debug('Attempting to determine the primary interface MAC address...')
     try:
@@ -176,19 +414,20 @@ def get_owner_id_from_mac_address():
 
     owner_id_url = metadata_url + 'network/interfaces/macs/' + mac_address + '/owner-id'
     try:
-        response = urllib.urlopen(owner_id_url)
-    except(IOError, OSError) as ex:
+        response = _imds_get(owner_id_url)
+    except AWSMetaDataError as ex:
         msg = 'Unable to query URL to get Owner ID: {u}\n{e}'.format(u=owner_id_url, e=ex)
         log.error(msg)
         return
 
     # Check the code
-    if response.getcode() != 200:
+    if response.status_code != 200:
         msg = 'There was a problem querying url: {u}, returned code: {c}, unable to get the Owner ID'.format(
-            u=owner_id_url, c=response.getcode())
+            u=owner_id_url, c=response.status_code)
         log.error(msg)
         return
-    owner_id = response.read()
+    owner_id = response.content
+    _metadata_cache['owner-id'] = owner_id
     return owner_id
 
 
@@ -199,26 +438,36 @@ def get_availability_zone():
     """
     log = logging.getLogger(mod_logger + '.get_availability_zone')
 
+    if 'availability-zone' in _metadata_cache:
+        return _metadata_cache['availability-zone']
+
     # Exit if not running on AWS
     if not is_aws():
         log.info('This machine is not running in AWS, exiting...')
         return
 
+    # Use the instance identity document when available
+    availability_zone = _get_identity_document_value('availabilityZone')
+    if availability_zone:
+        _metadata_cache['availability-zone'] = availability_zone
+        return availability_zone
+
     availability_zone_url = metadata_url + 'placement/availability-zone'
     try:
-        response = urllib.urlopen(availability_zone_url)
-    except(IOError, OSError) as ex:
+        response = _imds_get(availability_zone_url)
+    except AWSMetaDataError as ex:
         msg = 'Unable to query URL to get Availability Zone: {u}\n{e}'.format(u=availability_zone_url, e=ex)
         log.error(msg)
         return
 
     # Check the code
-    if response.getcode() != 200:
+    if response.status_code != 200:
         msg = 'There was a problem querying url: {u}, returned code: {c}, unable to get the Availability Zone'.format(
-            u=availability_zone_url, c=response.getcode())
+            u=availability_zone_url, c=response.status_code)
         log.error(msg)
         return
-    availability_zone = response.read()
+    availability_zone = response.content
+    _metadata_cache['availability-zone'] = availability_zone
     return availability_zone
 
 
@@ -229,7 +478,40 @@ def get_region():
     """
     log = logging.getLogger(mod_logger + '.get_region')
 
-    # First get the availability zone
+    if 'region' in _metadata_cache:
+        return _metadata_cache['region']
+
+    # Use the instance identity document when available
+    region = _get_identity_document_value('region')
+    if region:
+        _metadata_cache['region'] = region
+        return region
+
+    # Exit if not running on AWS
+    if not is_aws():
+        log.info('This machine is not running in AWS, exiting...')
+        return
+
+    # Otherwise query the region directly
+    region_url = metadata_url + 'placement/region'
+    try:
+        response = _imds_get(region_url)
+    except AWSMetaDataError as ex:
+        msg = 'Unable to query URL to get Region: {u}\n{e}'.format(u=region_url, e=ex)
+        log.error(msg)
+        return
+    if response.status_code == 200:
+        region = response.content
+        _metadata_cache['region'] = region
+        return region
+    elif response.status_code != 404:
+        msg = 'There was a problem querying url: {u}, returned code: {c}, unable to get the Region'.format(
+            u=region_url, c=response.status_code)
+        log.error(msg)
+        return
+
+    # Older instances do not provide the region, derive it from the availability zone
+    log.debug('Region not found in meta data, determining it from the Availability Zone...')
     availability_zone = get_availability_zone()
 
     if availability_zone is None:
@@ -239,6 +521,7 @@ def get_region():
 
     # Strip of the last character to get the region
     region = availability_zone[:-1]
+    _metadata_cache['region'] = region
     return region
 
 
@@ -250,7 +533,17 @@ def get_primary_mac_address():
     :raises: AWSMetaDataError
     """
     log = logging.getLogger(mod_logger + '.get_primary_mac_address')
+    if 'mac' in _metadata_cache:
+        return _metadata_cache['mac']
     log.debug('Attempting to determine the MAC address for eth0...')
+    mac_address = _read_system_file('/sys/class/net/eth0/address')
+    if mac_address:
+        _metadata_cache['mac'] = mac_address
+        return mac_address
+    if netifaces is None:
+        msg = 'Unable to read the eth0 mac address from sysfs and netifaces is not installed'
+        log.error(msg)
+        raise AWSMetaDataError(msg)
     try:
         mac_address = netifaces.ifaddresses('eth0')[netifaces.AF_LINK][0]['addr']
     except Exception:
@@ -258,4 +551,5 @@ def get_primary_mac_address():
         msg = '{n}: Unable to determine the eth0 mac address for this system:\n{e}'.format(
             n=ex.__class__.__name__, e=str(ex))
         raise AWSMetaDataError, msg, trace
+    _metadata_cache['mac'] = mac_address
     return mac_address
@@ -14,19 +14,27 @@ Classes:
         connecting to S3, or a problem with a download or upload
         operation.
 """
+import calendar
 import logging
 import re
 import os
+import random
 import sys
+import threading
 import time
+from multiprocessing.pool import ThreadPool
 
 # Pass ImportError on boto3 for offline assets
 try:
     import boto3
+    from boto3.s3.transfer import TransferConfig
     from botocore.client import ClientError
+    from botocore.exceptions import BotoCoreError
 except ImportError:
     boto3 = None
+    TransferConfig = None
     ClientError = None
+    BotoCoreError = None
     pass
 
 from pycons3rt.logify import Logify
@@ -37,6 +45,22 @@ __author__ = 'Joe Yennaco'
 # Set up logger name for this module
 mod_logger = Logify.get_name() + '.awsapi.s3util'
 
+# Maximum number of threads used to list keys concurrently
+max_list_threads = 16
+
+# Download and upload objects larger than 8 MB in 8 MB parts using 10 threads
+if TransferConfig is not None:
+    transfer_config = TransferConfig(multipart_threshold=8 * 1024 * 1024, max_concurrency=10,
+                                     multipart_chunksize=8 * 1024 * 1024, use_threads=True)
+else:
+    transfer_config = None
+
+# S3 clients and resources shared across S3Util instances and module
+# methods, keyed on region and credentials
+_client_cache = {}
+_resource_cache = {}
+_cache_lock = threading.Lock()
+
 
 class S3UtilError(Exception):
     """Simple exception type for S3Util errors
@@ -44,6 +68,160 @@ class S3UtilError(Exception):
     pass
 
 
+def _get_client(region_name=None, aws_access_key_id=None, aws_secret_access_key=None):
+    """Returns an S3 client for the region and credentials, clients are
+    created once and shared since creating one is expensive
+
+    :param region_name: (str) AWS region (optional)
+    :param aws_access_key_id: (str) AWS Access Key ID (optional)
+    :param aws_secret_access_key: (str) AWS Secret Access Key (optional)
+    :return: (boto3.client) S3 client
+    """
+    cache_key = (region_name, aws_access_key_id, aws_secret_access_key)
+    with _cache_lock:
+        if cache_key not in _client_cache:
+            _client_cache[cache_key] = boto3.client(
+                's3', region_name=region_name, aws_access_key_id=aws_access_key_id,
+                aws_secret_access_key=aws_secret_access_key)
+        return _client_cache[cache_key]
+
+
+def _get_resource(region_name=None, aws_access_key_id=None, aws_secret_access_key=None):
+    """Returns an S3 resource for the region and credentials, resources
+    are created once and shared
+
+    :param region_name: (str) AWS region (optional)
+    :param aws_access_key_id: (str) AWS Access Key ID (optional)
+    :param aws_secret_access_key: (str) AWS Secret Access Key (optional)
+    :return: (boto3.resource) S3 resource
+    """
+    cache_key = (region_name, aws_access_key_id, aws_secret_access_key)
+    with _cache_lock:
+        if cache_key not in _resource_cache:
+            _resource_cache[cache_key] = boto3.resource(
+                's3', region_name=region_name, aws_access_key_id=aws_access_key_id,
+                aws_secret_access_key=aws_secret_access_key)
+        return _resource_cache[cache_key]
+
+
+def _backoff_sec(count, base_sec=0.2, max_sec=5.0):
+    """Returns the exponential backoff with jitter for a retry attempt
+
+    :param count: (int) Attempt number starting at 1
+    :param base_sec: (float) Delay for the first retry
+    :param max_sec: (float) Maximum delay before jitter
+    :return: (float) Seconds to sleep before the next attempt
+    """
+    return min(max_sec, base_sec * 2 ** (count - 1)) + random.uniform(0, base_sec)
+
+
+def _extract_literal_prefix(regex):
+    """Determines the literal S3 key prefix that any key matching the
+    regex must start with
+
+    Only regular expressions anchored with ^ produce a prefix, an
+    unanchored regex can match anywhere in a key.
+
+    :param regex: (str) Regular expression for an S3 key
+    :return: (str) Literal key prefix, or an empty string when none
+        can be determined
+    """
+    if not regex.startswith('^') or '|' in regex:
+        return ''
+    prefix = ''
+    i = 1
+    while i < len(regex):
+        c = regex[i]
+        if c == '\\':
+            # Escaped punctuation is a literal, escaped letters and digits are classes or references
+            if i + 1 >= len(regex) or regex[i + 1].isalnum():
+                break
+            c = regex[i + 1]
+            i += 2
+        elif c in '.^$*+?{}[]()':
+            break
+        else:
+            i += 1
+        # A literal followed by an optional quantifier may not be present
+        if i < len(regex) and regex[i] in '*?{':
+            break
+        prefix += c
+        if i < len(regex) and regex[i] == '+':
+            break
+    return prefix
+
+
+def _list_keys(s3client, bucket_name, prefix=''):
+    """Generator for the keys in an S3 bucket starting with prefix
+
+    :param s3client: (boto3.client) S3 client
+    :param bucket_name: (str) Name of the S3 bucket
+    :param prefix: (str) Key prefix to list
+    :return: Generator of (str) S3 keys
+    """
+    paginator = s3client.get_paginator('list_objects_v2')
+    pages = paginator.paginate(Bucket=bucket_name, Prefix=prefix, PaginationConfig={'PageSize': 1000})
+    for page in pages:
+        for item in page.get('Contents', []):
+            yield item['Key']
+
+
+def _list_keys_parallel(s3client, bucket_name, prefix=''):
+    """Generator for the keys in an S3 bucket starting with prefix,
+    listing each "directory" under the prefix in its own thread
+
+    Keys up to the next / after the prefix are listed first, then the
+    common prefixes found are listed concurrently, which overlaps the
+    round trips of the many list requests needed for a large bucket.
+
+    :param s3client: (boto3.client) S3 client
+    :param bucket_name: (str) Name of the S3 bucket
+    :param prefix: (str) Key prefix to list
+    :return: Generator of (str) S3 keys
+    """
+    paginator = s3client.get_paginator('list_objects_v2')
+    pages = paginator.paginate(Bucket=bucket_name, Prefix=prefix, Delimiter='/',
+                               PaginationConfig={'PageSize': 1000})
+    common_prefixes = []
+    for page in pages:
+        for item in page.get('Contents', []):
+            yield item['Key']
+        for common_prefix in page.get('CommonPrefixes', []):
+            common_prefixes.append(common_prefix['Prefix'])
+    if not common_prefixes:
+        return
+    pool = ThreadPool(processes=min(max_list_threads, len(common_prefixes)))
+    try:
+        for keys in pool.imap(lambda p: list(_list_keys(s3client, bucket_name, p)), common_prefixes):
+            for key in keys:
+                yield key
+    finally:
+        pool.terminate()
+
+
+def _find_keys_iter(s3client, bucket_name, regex):
+    """Generator yielding S3 keys in a bucket matching the passed regex
+
+    :param s3client: boto3 S3 client
+    :param bucket_name: (str) Name of the bucket to search
+    :param regex: (str) Regular expression to use is the key search
+    :return: generator of matching key names
+    """
+    log = logging.getLogger(mod_logger + '._find_keys_iter')
+    compiled_regex = re.compile(regex)
+    prefix = _extract_literal_prefix(regex)
+    if prefix:
+        keys = _list_keys(s3client, bucket_name, prefix)
+    else:
+        keys = _list_keys_parallel(s3client, bucket_name)
+    debug = log.isEnabledFor(logging.DEBUG)
+    for key in keys:
+        if debug:
+            log.debug('Checking if regex matches key: %s', key)
+        if compiled_regex.search(key):
+            yield key
+
+
 class S3Util(object):
     """Utility class for interacting with AWS S3
 
@@ -60,6 +238,10 @@ class S3Util(object):
         s3resource (boto3.resource): High level AWS S3 resource
         bucket (Bucket): S3 Bucket object for performing Bucket operations
     """
+    # Buckets already validated by this process, keyed on bucket name and client
+    _validated_buckets = set()
+    _validated_buckets_lock = threading.Lock()
+
     def __init__(self, _bucket_name, region_name=None, aws_access_key_id=None, aws_secret_access_key=None):
         self.cls_logger = mod_logger + '.S3Util'
         log = logging.getLogger(self.cls_logger + '.__init__')
@@ -68,11 +250,11 @@ class S3Util(object):
         log.debug('Configuring S3 client with AWS Access key ID {k} and region {r}'.format(
             k=aws_access_key_id, r=region_name))
 
-        self.s3resource = boto3.resource('s3', region_name=region_name, aws_access_key_id=aws_access_key_id,
-                                         aws_secret_access_key=aws_secret_access_key)
+        self.s3resource = _get_resource(region_name=region_name, aws_access_key_id=aws_access_key_id,
+                                        aws_secret_access_key=aws_secret_access_key)
         try:
-            self.s3client = boto3.client('s3', region_name=region_name, aws_access_key_id=aws_access_key_id,
-                                         aws_secret_access_key=aws_secret_access_key)
+            self.s3client = _get_client(region_name=region_name, aws_access_key_id=aws_access_key_id,
+                                        aws_secret_access_key=aws_secret_access_key)
         except ClientError:
             _, ex, trace = sys.exc_info()
             msg = 'There was a problem connecting to S3, please check AWS configuration or credentials provided, ' \
@@ -86,11 +268,17 @@ class S3Util(object):
         """Verify the specified bucket exists
 
         This method validates that the bucket name passed in the S3Util
-        constructor actually exists.
+        constructor actually exists. A bucket is only validated once
+        per process for each S3 client.
 
         :return: None
         """
         log = logging.getLogger(self.cls_logger + '.validate_bucket')
+        validated_key = (self.bucket_name, self.s3client)
+        with S3Util._validated_buckets_lock:
+            if validated_key in S3Util._validated_buckets:
+                log.debug('Bucket already validated: {b}'.format(b=self.bucket_name))
+                return
         log.info('Attempting to get bucket: {b}'.format(b=self.bucket_name))
         max_tries = 10
         count = 1
@@ -117,8 +305,9 @@ class S3Util(object):
                         log.error(msg)
                         raise S3UtilError, msg, trace
                     else:
-                        log.warn('AWS returned error code 500 or 503, re-trying in 2 sec...')
-                        time.sleep(5)
+                        retry_sec = _backoff_sec(count)
+                        log.warn('AWS returned error code 500 or 503, re-trying in {t:.2f} sec...'.format(t=retry_sec))
+                        time.sleep(retry_sec)
                         count += 1
                         continue
                 else:
@@ -128,6 +317,8 @@ class S3Util(object):
                     raise S3UtilError, msg, trace
             else:
                 log.info('Found bucket: %s', self.bucket_name)
+                with S3Util._validated_buckets_lock:
+                    S3Util._validated_buckets.add(validated_key)
                 return
 
     def __download_from_s3(self, key, dest_dir):
@@ -158,7 +349,7 @@ class S3Util(object):
                      count, max_tries)
             try:
                 self.s3client.download_file(
-                    Bucket=self.bucket_name, Key=key, Filename=destination)
+                    Bucket=self.bucket_name, Key=key, Filename=destination, Config=transfer_config)
             except ClientError:
                 if count >= max_tries:
                     _, ex, trace = sys.exc_info()
@@ -167,9 +358,10 @@ class S3Util(object):
                     log.error(msg)
                     raise S3UtilError, msg, trace
                 else:
-                    log.warn('Download failed, re-trying...')
+                    retry_sec = _backoff_sec(count)
+                    log.warn('Download failed, re-trying in %.2f sec...', retry_sec)
                     count += 1
-                    time.sleep(5)
+                    time.sleep(retry_sec)
                     continue
             else:
                 log.info('Successfully downloaded %s from S3 bucket %s to: %s',
@@ -254,11 +446,16 @@ class S3Util(object):
             return None
         log.info('Looking up a single S3 key based on regex: %s', regex)
         matched_keys = []
-        for item in self.bucket.objects.all():
-            log.debug('Checking if regex matches key: %s', item.key)
-            match = re.search(regex, item.key)
-            if match:
-                matched_keys.append(item.key)
+        compiled_regex = re.compile(regex)
+        debug = log.isEnabledFor(logging.DEBUG)
+        for key in _list_keys(self.s3client, self.bucket_name, _extract_literal_prefix(regex)):
+            if debug:
+                log.debug('Checking if regex matches key: %s', key)
+            if compiled_regex.search(key):
+                matched_keys.append(key)
+                # No need to keep searching once more than 1 key matches
+                if len(matched_keys) > 1:
+                    break
         if len(matched_keys) == 1:
             log.info('Found matching key: %s', matched_keys[0])
             return matched_keys[0]
@@ -281,27 +478,39 @@ class S3Util(object):
         :return: Array of strings containing matched S3 keys
         """
         log = logging.getLogger(self.cls_logger + '.find_keys')
-        matched_keys = []
         if not isinstance(regex, basestring):
             log.error('regex argument is not a string, found: {t}'.format(t=regex.__class__.__name__))
             return None
 
         # Determine which bucket to use
         if bucket_name is None:
-            s3bucket = self.bucket
+            bucket_name = self.bucket_name
         else:
             log.debug('Using the provided S3 bucket: {n}'.format(n=bucket_name))
-            s3bucket = self.s3resource.Bucket(bucket_name)
 
         log.info('Looking up S3 keys based on regex: {r}'.format(r=regex))
-        for item in s3bucket.objects.all():
-            log.debug('Checking if regex matches key: {k}'.format(k=item.key))
-            match = re.search(regex, item.key)
-            if match:
-                matched_keys.append(item.key)
-        log.info('Found matching keys: {k}'.format(k=matched_keys))
+        matched_keys = list(_find_keys_iter(self.s3client, bucket_name, regex))
+        log.info('Found {n} matching keys'.format(n=len(matched_keys)))
         return matched_keys
 
+    def iter_keys(self, regex, bucket_name=None):
+        """Iterates over S3 keys matching the passed regex
+
+        Same as find_keys but yields matching keys as they are listed
+        instead of building a list, for buckets with many matches.
+
+        :param regex: (str) Regular expression to use is the key search
+        :param bucket_name: (str) Name of bucket to search (optional)
+        :return: generator of strings containing matched S3 keys
+        """
+        log = logging.getLogger(self.cls_logger + '.iter_keys')
+        if not isinstance(regex, basestring):
+            log.error('regex argument is not a string, found: {t}'.format(t=regex.__class__.__name__))
+            return None
+        if bucket_name is None:
+            bucket_name = self.bucket_name
+        return _find_keys_iter(self.s3client, bucket_name, regex)
+
     def upload_file(self, filepath, key):
         """Uploads a file using the passed S3 key
 
@@ -330,7 +539,7 @@ class S3Util(object):
 
         try:
             self.s3client.upload_file(
-                Filename=filepath, Bucket=self.bucket_name, Key=key)
+                Filename=filepath, Bucket=self.bucket_name, Key=key, Config=transfer_config)
         except ClientError as e:
             log.error('Unable to upload file %s to bucket %s as key %s:\n%s',
                       filepath, self.bucket_name, key, e)
@@ -421,9 +630,9 @@ def download(download_info):
     log.debug('Configuring S3 client with AWS Access key ID {k} and region {r}'.format(
         k=aws_access_key_id, r=region_name))
 
-    # Establish an S3 client
-    client = boto3.client('s3', region_name=region_name, aws_access_key_id=aws_access_key_id,
-                          aws_secret_access_key=aws_secret_access_key)
+    # Get an S3 client
+    client = _get_client(region_name=region_name, aws_access_key_id=aws_access_key_id,
+                         aws_secret_access_key=aws_secret_access_key)
 
     # Attempt to determine the file name from key
     filename = key.split('/')[-1]
@@ -435,21 +644,31 @@ def download(download_info):
     # Set the destination
     destination = os.path.join(dest_dir, filename)
 
-    # Return if the destination file was already downloaded
+    # Return if the destination file was already downloaded and matches the S3 object
     if os.path.isfile(destination):
-        log.info('File already downloaded: {d}'.format(d=destination))
-        return destination
+        try:
+            head = client.head_object(Bucket=bucket_name, Key=key)
+        except (ClientError, BotoCoreError):
+            _, ex, trace = sys.exc_info()
+            log.warn('Unable to check key {k} in S3 bucket {b}, using the existing file: {d}\n{e}'.format(
+                k=key, b=bucket_name, d=destination, e=str(ex)))
+            return destination
+        local_stat = os.stat(destination)
+        remote_mtime = calendar.timegm(head['LastModified'].utctimetuple())
+        if local_stat.st_size == head['ContentLength'] and local_stat.st_mtime >= remote_mtime:
+            log.info('File already downloaded: {d}'.format(d=destination))
+            return destination
+        log.info('Existing file {d} differs from key {k}, downloading again'.format(d=destination, k=key))
 
     # Attempt the download
     log.info('Attempting to download %s from bucket %s to destination %s',
              key, bucket_name, destination)
     max_tries = 10
-    retry_timer = 5
     count = 1
     while count <= max_tries:
         log.info('Attempting to download file {k}: try {c} of {m}'.format(k=key, c=count, m=max_tries))
         try:
-            client.download_file(Bucket=bucket_name, Key=key, Filename=destination)
+            client.download_file(Bucket=bucket_name, Key=key, Filename=destination, Config=transfer_config)
         except ClientError:
             if count >= max_tries:
                 _, ex, trace = sys.exc_info()
@@ -457,9 +676,10 @@ def download(download_info):
                 log.error(msg)
                 raise S3UtilError, msg, trace
             else:
-                log.warn('Download failed, re-trying in {t} sec...'.format(t=retry_timer))
+                retry_sec = _backoff_sec(count)
+                log.warn('Download failed, re-trying in {t:.2f} sec...'.format(t=retry_sec))
                 count += 1
-                time.sleep(retry_timer)
+                time.sleep(retry_sec)
                 continue
         else:
             log.info('Successfully downloaded {k} from S3 bucket {b} to: {d}'.format(
@@ -482,7 +702,6 @@ def find_bucket_keys(bucket_name, regex, region_name=None, aws_access_key_id=Non
     :return: Array of strings containing matched S3 keys
     """
     log = logging.getLogger(mod_logger + '.find_bucket_keys')
-    matched_keys = []
     if not isinstance(regex, basestring):
         log.error('regex argument is not a string, found: {t}'.format(t=regex.__class__.__name__))
         return None
@@ -490,21 +709,41 @@ def find_bucket_keys(bucket_name, regex, region_name=None, aws_access_key_id=Non
         log.error('bucket_name argument is not a string, found: {t}'.format(t=bucket_name.__class__.__name__))
         return None
 
-    # Set up S3 resources
-    s3resource = boto3.resource('s3', region_name=region_name, aws_access_key_id=aws_access_key_id,
-                                aws_secret_access_key=aws_secret_access_key)
-    bucket = s3resource.Bucket(bucket_name)
+    # Get an S3 client
+    s3client = _get_client(region_name=region_name, aws_access_key_id=aws_access_key_id,
+                           aws_secret_access_key=aws_secret_access_key)
 
     log.info('Looking up S3 keys based on regex: {r}'.format(r=regex))
-    for item in bucket.objects.all():
-        log.debug('Checking if regex matches key: {k}'.format(k=item.key))
-        match = re.search(regex, item.key)
-        if match:
-            matched_keys.append(item.key)
-    log.info('Found matching keys: {k}'.format(k=matched_keys))
+    matched_keys = list(_find_keys_iter(s3client, bucket_name, regex))
+    log.info('Found {n} matching keys'.format(n=len(matched_keys)))
     return matched_keys
 
 
+def iter_bucket_keys(bucket_name, regex, region_name=None, aws_access_key_id=None, aws_secret_access_key=None):
+    """Iterates over S3 keys matching the passed regex
+
+    Same as find_bucket_keys but yields matching keys as they are
+    listed instead of building a list, for buckets with many matches.
+
+    :param bucket_name: (str) String S3 bucket name
+    :param regex: (str) Regular expression to use is the key search
+    :param region_name: (str) AWS region for the S3 bucket (optional)
+    :param aws_access_key_id: (str) AWS Access Key ID (optional)
+    :param aws_secret_access_key: (str) AWS Secret Access Key (optional)
+    :return: generator of strings containing matched S3 keys
+    """
+    log = logging.getLogger(mod_logger + '.iter_bucket_keys')
+    if not isinstance(regex, basestring):
+        log.error('regex argument is not a string, found: {t}'.format(t=regex.__class__.__name__))
+        return None
+    if not isinstance(bucket_name, basestring):
+        log.error('bucket_name argument is not a string, found: {t}'.format(t=bucket_name.__class__.__name__))
+        return None
+    s3client = _get_client(region_name=region_name, aws_access_key_id=aws_access_key_id,
+                           aws_secret_access_key=aws_secret_access_key)
+    return _find_keys_iter(s3client, bucket_name, regex)
+
+
 def main():
     """Sample usage for this python module
 
@@ -6,21 +6,51 @@ This module provides utilities for running standard bash commands
 from python.
 
 """
+import atexit
+import copy
 import logging
 import os
+import pipes
 import subprocess
+import array
 import errno
-import fileinput
+import fcntl
+import functools
+import glob
 import re
+import select
+import shlex
 import sys
 import zipfile
 import socket
-import contextlib
+import struct
 import time
 import platform
 import shutil
+import signal
+import stat
+import tempfile
+import threading
 from datetime import datetime
-from threading import Timer
+from multiprocessing.pool import ThreadPool
+from threading import Lock, Timer
+
+# python-iptables is optional, iptables commands are used when it is not installed or fails to load
+# (e.g. XTablesError when libxtables is missing or mismatched), the load error is logged below
+_iptc_import_error = None
+try:
+    import iptc
+except ImportError:
+    iptc = None
+except Exception:
+    _, _iptc_import_error, _ = sys.exc_info()
+    iptc = None
+
+# paramiko is optional, the remote helpers can use it instead of the ssh command when use_paramiko is set
+try:
+    import paramiko
+except ImportError:
+    paramiko = None
 
 from logify import Logify
 
@@ -30,6 +60,114 @@ __author__ = 'Joe Yennaco'
 # Set up logger name for this module
 mod_logger = Logify.get_name() + '.bash'
 
+if _iptc_import_error is not None:
+    logging.getLogger(mod_logger).warn(
+        'Unable to load python-iptables, using iptables commands instead\n{e}'.format(e=str(_iptc_import_error)))
+
+# ioctl requests to list interfaces and to get the IPv4 and hardware address of an interface
+SIOCGIFCONF = 0x8912
+SIOCGIFADDR = 0x8915
+SIOCGIFHWADDR = 0x8927
+
+# rtnetlink multicast groups for link and IPv4 address changes
+RTMGRP_LINK = 0x1
+RTMGRP_IPV4_IFADDR = 0x10
+
+# Size of struct ifreq returned by SIOCGIFCONF, larger on 64-bit due to alignment
+ifreq_size = 40 if struct.calcsize('P') == 8 else 32
+
+# Matches a plain variable assignment in a script that source can read without a shell
+simple_assignment_regex = re.compile(r'^(export\s+)?([A-Za-z_]\w*)=(.*)$')
+shell_special_chars = set('$`\\;&|<>()~')
+
+# Patterns for config file lines edited with sed
+hostname_regex = re.compile(r'^HOSTNAME=.*')
+ntp_server_regex = re.compile(r'^server.*')
+device_regex = re.compile(r'^DEVICE=.*')
+
+# Cached result of is_systemd, the init system does not change while running
+_is_systemd_cached = None
+
+# Output of ip addr show shared by the address lookups, refreshed after ip_addr_cache_ttl_sec
+ip_addr_cache_ttl_sec = 5.0
+_ip_addr_cache = {'output': None, 'timestamp': 0}
+
+# Interface lookups from get_ip_addresses, get_mac_address and get_ip, refreshed after interface_cache_ttl_sec
+interface_cache_ttl_sec = 5.0
+
+# Device IP addresses used for NAT rules, refreshed after nat_ip_addresses_ttl_sec
+nat_ip_addresses_ttl_sec = 30.0
+_nat_ip_addresses_cache = {'ip_addresses': None, 'timestamp': 0}
+
+# Commands to dump, to add to, and to persist the running iptables rules
+iptables_dump_command = ['iptables-save']
+iptables_restore_command = ['iptables-restore', '--noflush']
+iptables_save_command = ['/etc/init.d/iptables', 'save']
+
+# OpenSSH connection sharing, repeated remote commands to a host re-use one master connection
+# that stays up for ssh_control_persist_sec after its last use, starting it is given up on after
+# ssh_master_timeout_sec and the host then uses plain ssh connections
+ssh_control_persist_sec = 60
+ssh_master_timeout_sec = 5.0
+
+# Extra OpenSSH options for the remote helpers, replace to tune (e.g. add '-o', 'Ciphers=aes128-gcm@openssh.com')
+# Skips the Kerberos probe and compression, which only add latency for small command output
+ssh_options = [
+    '-o', 'GSSAPIAuthentication=no',
+    '-o', 'Compression=no'
+]
+
+# Private (0700) directory holding the master sockets, hosts with a master started by this process,
+# and hosts where starting a master failed
+_ssh_control_dir = None
+_ssh_control_hosts = set()
+_ssh_master_failed_hosts = set()
+_ssh_control_locks = {}
+_ssh_control_lock = Lock()
+
+# Set True to run remote commands over persistent paramiko connections instead of ssh subprocesses
+use_paramiko = False
+_paramiko_clients = {}
+_paramiko_clients_lock = Lock()
+
+# Loggers for run_command, which every remote helper calls, and the iptables helpers
+_run_command_log = logging.getLogger(mod_logger + '.run_command')
+_append_nat_rules_log = logging.getLogger(mod_logger + '._append_nat_rules')
+_add_nat_rules_log = logging.getLogger(mod_logger + '.add_nat_rules')
+_save_iptables_log = logging.getLogger(mod_logger + '.save_iptables')
+_restore_iptables_log = logging.getLogger(mod_logger + '.restore_iptables')
+
+# Loggers for the remote host helpers, which may be called in polling loops
+_get_remote_host_environment_variable_log = logging.getLogger(mod_logger + '.get_remote_host_environment_variable')
+_get_remote_host_environment_variable_many_log = logging.getLogger(
+    mod_logger + '.get_remote_host_environment_variable_many')
+_set_remote_host_environment_variable_log = logging.getLogger(mod_logger + '.set_remote_host_environment_variable')
+_run_remote_command_log = logging.getLogger(mod_logger + '.run_remote_command')
+_run_remote_commands_log = logging.getLogger(mod_logger + '.run_remote_commands')
+_run_remote_command_many_log = logging.getLogger(mod_logger + '.run_remote_command_many')
+_check_remote_host_marker_file_log = logging.getLogger(mod_logger + '.check_remote_host_marker_file')
+_check_remote_host_marker_files_log = logging.getLogger(mod_logger + '.check_remote_host_marker_files')
+_check_remote_host_marker_file_many_log = logging.getLogger(mod_logger + '.check_remote_host_marker_file_many')
+_create_remote_host_marker_file_log = logging.getLogger(mod_logger + '.create_remote_host_marker_file')
+_create_remote_host_marker_file_many_log = logging.getLogger(mod_logger + '.create_remote_host_marker_file_many')
+
+# System environment files that always exist, no need to create them or set permissions
+well_known_env_files = ['/etc/bashrc', '/etc/profile', '/etc/environment']
+
+# Marker files found on remote hosts, keyed by (host, file_path) with the time found
+marker_file_cache_ttl_sec = 2.0
+_marker_file_cache = {}
+_marker_file_cache_lock = Lock()
+
+# Remote environment variable values keyed by (host, variable) with the time read,
+# refreshed after remote_env_cache_ttl_sec, set PYCONS3RT_SSH_ENV_TTL to override
+try:
+    remote_env_cache_ttl_sec = float(os.environ.get('PYCONS3RT_SSH_ENV_TTL', 30.0))
+except ValueError:
+    remote_env_cache_ttl_sec = 30.0
+_remote_env_cache = {}
+_remote_env_cache_lock = Lock()
+
 
 class CommandError(Exception):
     """Error encompassing problems that could be encountered while
@@ -50,31 +188,95 @@ class SystemRebootTimeoutError(Exception):
     pass
 
 
-def process_killer(p):
-    """Returns a function to kill the process p
-    :param p: Process
-    :return: kill function for process p
+def _require_str(log, name, value, error=TypeError):
+    """Raises an error if an argument is not a string
+
+    :param log: (logging.Logger) logger of the calling function
+    :param name: (str) name of the argument
+    :param value: value of the argument
+    :param error: (Exception) type of error to raise
+    :return: None
+    :raises: error
+    """
+    if not isinstance(value, basestring):
+        msg = '{n} argument must be a string, found: {t}'.format(n=name, t=value.__class__.__name__)
+        log.error(msg)
+        raise error(msg)
+
+
+def _new_process_group():
+    """Moves the calling (child) process into its own process group, used
+    as the Popen preexec_fn
+
+    :return: None
+    """
+    os.setpgid(0, 0)
+
+
+def _kill_process(subproc):
+    """Kills a subprocess that may already have exited
+
+    :param subproc: (subprocess.Popen) process to kill
+    :return: None
     """
-    return p.kill()
+    try:
+        subproc.kill()
+    except OSError:
+        pass
 
 
-def enqueue_output(out, queue):
-    for line in iter(out.readline, b''):
-        queue.put(line)
-    out.close()
+def _kill_process_group(subproc):
+    """Kills the process group led by the provided subprocess
 
+    :param subproc: (subprocess.Popen) process started with _new_process_group
+    :return: None
+    """
+    try:
+        os.killpg(subproc.pid, signal.SIGKILL)
+    except OSError:
+        _, ex, _ = sys.exc_info()
+        if ex.errno != errno.ESRCH:
+            raise
+
+
+def _write_stdin(stdin, data):
+    """Writes data to the stdin pipe of a subprocess and closes it
 
-def run_command(command, timeout_sec=3600.0, output=True):
+    :param stdin: (file) stdin pipe of the subprocess
+    :param data: (str) data to write
+    :return: None
+    """
+    try:
+        stdin.write(data)
+    except IOError:
+        _, ex, _ = sys.exc_info()
+        if ex.errno != errno.EPIPE:
+            raise
+    finally:
+        try:
+            stdin.close()
+        except IOError:
+            pass
+
+
+def run_command(command, timeout_sec=3600.0, output=True, print_output=True, input=None, kill_process_group=False):
     """Runs a command using the subprocess module
 
     :param command: List containing the command and all args
     :param timeout_sec (float) seconds to wait before killing
         the command.
     :param output (bool) True collects output, False ignores output
+    :param print_output (bool) True echoes collected output to stdout
+        as it is read, False only returns it
+    :param input (str) data to send to the command on stdin, stdin
+        is /dev/null when None
+    :param kill_process_group (bool) True starts the command in its own
+        process group and kills the whole group on timeout, the command
+        then cannot read from the terminal
     :return: Dict containing the command output and return code
     :raises CommandError
     """
-    log = logging.getLogger(mod_logger + '.run_command')
+    log = _run_command_log
     if not isinstance(command, list):
         msg = 'command arg must be a list'
         log.error(msg)
@@ -85,79 +287,141 @@ def run_command(command, timeout_sec=3600.0, output=True):
     else:
         subproc_stdout = None
         subproc_stderr = None
-    command = map(str, command)
-    command_str = ' '.join(command)
+    command = [str(c) for c in command]
+    subproc = None
     timer = None
-    log.debug('Running command: {c}'.format(c=command_str))
-    output_collector = ''
+    stdin_writer = None
+    # The process group is set with a preexec_fn, which can deadlock the child if another thread holds
+    # a lock at fork time, so it is only used when asked for
+    kill = _kill_process_group if kill_process_group else _kill_process
+    log.debug('Running command: %s', ' '.join(command) if log.isEnabledFor(logging.DEBUG) else '')
+    output_buffer = bytearray()
     try:
         log.debug('Opening subprocess...')
         subproc = subprocess.Popen(
             command,
-            bufsize=1,
-            stdin=open(os.devnull),
+            bufsize=-1,
+            stdin=open(os.devnull) if input is None else subprocess.PIPE,
             stdout=subproc_stdout,
-            stderr=subproc_stderr
+            stderr=subproc_stderr,
+            preexec_fn=_new_process_group if kill_process_group else None
         )
-        log.debug('Opened subprocess wih PID: {p}'.format(p=subproc.pid))
-        log.debug('Setting up process kill timer for PID {p} at {s} sec...'.format(p=subproc.pid, s=timeout_sec))
-        kill_proc = process_killer
-        timer = Timer(timeout_sec, kill_proc, [subproc])
+        log.debug('Opened subprocess wih PID: %s', subproc.pid)
+        log.debug('Setting up process kill timer for PID %s at %s sec...', subproc.pid, timeout_sec)
+        timer = Timer(timeout_sec, kill, [subproc])
         timer.start()
+        if input is not None:
+            # Write stdin from a thread so a command producing output before reading its input cannot deadlock
+            stdin_writer = threading.Thread(target=_write_stdin, args=(subproc.stdin, input))
+            stdin_writer.daemon = True
+            stdin_writer.start()
         if output:
             log.debug('Collecting and logging output...')
             with subproc.stdout:
-                for line in iter(subproc.stdout.readline, b''):
-                    output_collector += line.rstrip() + '\n'
-                    print(">>> " + line.rstrip())
+                # Read output in large chunks, holding back any partial last line for printing
+                fd = subproc.stdout.fileno()
+                tail = ''
+                while True:
+                    try:
+                        chunk = os.read(fd, 65536)
+                    except OSError:
+                        _, ex, _ = sys.exc_info()
+                        if ex.errno == errno.EINTR:
+                            continue
+                        raise
+                    if not chunk:
+                        break
+                    output_buffer.extend(chunk)
+                    if print_output:
+                        lines = (tail + chunk).split('\n')
+                        tail = lines.pop()
+                        if lines:
+                            sys.stdout.write('>>> ' + '\n>>> '.join(line.rstrip() for line in lines) + '\n')
+                            sys.stdout.flush()
+                if print_output and tail:
+                    sys.stdout.write('>>> ' + tail.rstrip() + '\n')
+                    sys.stdout.flush()
         log.debug('Waiting for process completion...')
-        subproc.wait()
-        log.debug('Collecting the exit code...')
-        code = subproc.poll()
+        code = subproc.wait()
+        if stdin_writer is not None:
+            stdin_writer.join()
     except ValueError:
         _, ex, trace = sys.exc_info()
         msg = 'Bad command supplied: {c}\n{e}'.format(
-            c=command_str, e=str(ex)
+            c=' '.join(command), e=str(ex)
         )
         log.error(msg)
         raise CommandError, msg, trace
     except (OSError, IOError):
         _, ex, trace = sys.exc_info()
         msg = 'There was a problem running command: {c}\n{e}'.format(
-            c=command_str, e=str(ex))
+            c=' '.join(command), e=str(ex))
         log.error(msg)
         raise CommandError, msg, trace
     except subprocess.CalledProcessError:
         _, ex, trace = sys.exc_info()
         msg = 'Command returned a non-zero exit code: {c}, return code: {cde}\n{e}'.format(
-            c=command_str, cde=ex.returncode, e=ex)
+            c=' '.join(command), cde=ex.returncode, e=ex)
         log.error(msg)
         raise CommandError, msg, trace
     finally:
+        # Do not leave the command running when interrupted or failing before it exits
+        if subproc is not None and subproc.returncode is None:
+            log.debug('Killing unfinished process with PID %s...', subproc.pid)
+            kill(subproc)
+            subproc.wait()
         if timer is not None:
             log.debug('Cancelling the timer...')
             timer.cancel()
         else:
             log.debug('No need to cancel the timer.')
     # Collect exit code and output for return
-    output = output_collector.strip()
-    try:
-        code = int(code)
-    except ValueError:
-        _, ex, trace = sys.exc_info()
-        msg = 'Return code {c} could not be parsed into an int\n{e}'.format(
-            c=code, e=str(ex))
-        log.error(msg)
-        raise CommandError, msg, trace
-    else:
-        log.debug('Command executed and returned code: {c} with output:\n{o}'.format(c=code, o=output))
-        output = {
-            'output': output,
-            'code': code
-        }
+    output = '\n'.join(line.rstrip() for line in str(output_buffer).split('\n')).strip()
+    log.debug('Command executed and returned code: %s with output:\n%s', code, output)
+    output = {
+        'output': output,
+        'code': code
+    }
     return output
 
 
+def run_commands_parallel(commands, max_workers=8, timeout_sec=3600.0, print_output=False):
+    """Runs several independent commands concurrently
+
+    :param commands: (list) of commands, each a list containing the
+        command and all args
+    :param max_workers: (int) maximum number of commands to run at once
+    :param timeout_sec (float) seconds to wait before killing each
+        command.
+    :param print_output (bool) True echoes output to stdout as it is
+        read, lines from different commands may interleave
+    :return: (list) of run_command output dicts, or the CommandError
+        raised for that command, in the same order as commands
+    :raises CommandError
+    """
+    log = logging.getLogger(mod_logger + '.run_commands_parallel')
+    if not isinstance(commands, list):
+        msg = 'commands arg must be a list'
+        log.error(msg)
+        raise CommandError(msg)
+    if not commands:
+        return []
+
+    def run(command):
+        try:
+            return run_command(command, timeout_sec=timeout_sec, print_output=print_output)
+        except CommandError as ex:
+            return ex
+
+    log.debug('Running %s commands with up to %s workers...', len(commands), max_workers)
+    pool = ThreadPool(min(max_workers, len(commands)))
+    try:
+        results = pool.map(run, commands)
+    finally:
+        pool.terminate()
+    return results
+
+
 def validate_ip_address(ip_address):
     """Validate the ip_address
 
@@ -190,24 +454,79 @@ def validate_ip_address(ip_address):
         return True
 
 
-def ip_addr():
-    """Uses the ip addr command to enumerate IP addresses by device
+def _interface_cache(func):
+    """Decorator that caches the result of an interface lookup per set
+    of args for interface_cache_ttl_sec
 
-    :return: (dict) Containing device: ip_address
+    Callers get a copy of the cached result, so changing it does not
+    change the cache. The decorated function gets a cache_clear()
+    method to drop all cached results.
+
+    :param func: function to cache
+    :return: wrapped function
     """
-    log = logging.getLogger(mod_logger + '.ip_addr')
-    log.debug('Running the ip addr command...')
-    ip_addr_output = {}
+    cache = {}
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        key = (args, tuple(sorted(kwargs.items())))
+        now = time.time()
+        entry = cache.get(key)
+        if entry is not None and now - entry[1] < interface_cache_ttl_sec:
+            return copy.copy(entry[0])
+        result = func(*args, **kwargs)
+        cache[key] = (result, now)
+        return copy.copy(result)
+    wrapper.cache_clear = cache.clear
+    return wrapper
+
+
+def clear_ip_addr_cache():
+    """Clears the cached ip addr output and interface lookups, call
+    after changing network configuration
+
+    :return: None
+    """
+    _ip_addr_cache['output'] = None
+    _ip_addr_cache['timestamp'] = 0
+    _nat_ip_addresses_cache['ip_addresses'] = None
+    _nat_ip_addresses_cache['timestamp'] = 0
+    get_ip_addresses.cache_clear()
+    get_mac_address.cache_clear()
+    get_ip.cache_clear()
+
+
+def _ip_addr_show():
+    """Returns the output of the ip addr show command, re-using the
+    output of a recent call
 
-    command = ['ip', 'addr']
+    :return: (str) ip addr show output
+    :raises CommandError
+    """
+    log = logging.getLogger(mod_logger + '._ip_addr_show')
+    now = time.time()
+    if _ip_addr_cache['output'] is not None and now - _ip_addr_cache['timestamp'] < ip_addr_cache_ttl_sec:
+        return _ip_addr_cache['output']
+    log.debug('Running the ip addr command...')
+    command = ['ip', 'addr', 'show']
     try:
-        ip_addr_result = run_command(command, timeout_sec=20)
+        result = run_command(command, timeout_sec=20, print_output=False)
     except CommandError:
         _, ex, trace = sys.exc_info()
         msg = 'There was a problem running command: {c}'.format(c=' '.join(command))
         raise CommandError, msg, trace
+    _ip_addr_cache['output'] = result['output']
+    _ip_addr_cache['timestamp'] = now
+    return result['output']
 
-    ip_addr_lines = ip_addr_result['output'].split('\n')
+
+def ip_addr():
+    """Uses the ip addr command to enumerate IP addresses by device
+
+    :return: (dict) Containing device: ip_address
+    """
+    ip_addr_output = {}
+    ip_addr_lines = _ip_addr_show().split('\n')
 
     for line in ip_addr_lines:
         line = line.strip()
@@ -232,41 +551,48 @@ def ip_addr():
     return ip_addr_output
 
 
+@_interface_cache
 def get_ip_addresses():
-    """Gets the ip addresses from ifconfig
+    """Gets the ip addresses of the eth/eno devices from the kernel
 
     :return: (dict) of devices and aliases with the IPv4 address
+    :raises CommandError
     """
     log = logging.getLogger(mod_logger + '.get_ip_addresses')
 
-    command = ['/sbin/ifconfig']
+    # List the configured IPv4 interfaces with SIOCGIFCONF, growing the buffer until they all fit
+    max_interfaces = 32
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
     try:
-        result = run_command(command)
-    except CommandError:
-        raise
-    ifconfig = result['output'].strip()
+        while True:
+            buf_size = max_interfaces * ifreq_size
+            buf = array.array('B', '\0' * buf_size)
+            ifconf = struct.pack('iL', buf_size, buf.buffer_info()[0])
+            out_size = struct.unpack('iL', fcntl.ioctl(sock.fileno(), SIOCGIFCONF, ifconf))[0]
+            if out_size < buf_size:
+                break
+            max_interfaces *= 2
+    except IOError:
+        _, ex, trace = sys.exc_info()
+        msg = 'Unable to list network interfaces\n{e}'.format(e=str(ex))
+        log.error(msg)
+        raise CommandError, msg, trace
+    finally:
+        sock.close()
+    ifreqs = buf.tostring()
 
-    # Scan the ifconfig output for IPv4 addresses
     devices = {}
-    parts = ifconfig.split()
-    device = None
-    for part in parts:
-
-        if device is None:
-            if 'eth' in part or 'eno' in part:
-                device = part
-        else:
-            test = part.split(':', 1)
-            if len(test) == 2:
-                if test[0] == 'addr':
-                    ip_address = test[1]
-                    log.info('Found IP address %s on device %s', ip_address,
-                             device)
-                    devices[device] = ip_address
-                    device = None
+    for offset in xrange(0, out_size, ifreq_size):
+        device = ifreqs[offset:offset + 16].split('\0', 1)[0]
+        if 'eth' not in device and 'eno' not in device:
+            continue
+        ip_address = socket.inet_ntoa(ifreqs[offset + 20:offset + 24])
+        log.info('Found IP address %s on device %s', ip_address, device)
+        devices[device] = ip_address
     return devices
 
 
+@_interface_cache
 def get_mac_address(device_index=0):
     """Returns the Mac Address given a device index
 
@@ -274,27 +600,19 @@ def get_mac_address(device_index=0):
     :return: (str) Mac address or None
     """
     log = logging.getLogger(mod_logger + '.get_mac_address')
-    command = ['ip', 'addr', 'show', 'eth{d}'.format(d=device_index)]
+    device = 'eth{d}'.format(d=device_index)
     log.info('Attempting to find a mac address at device index: {d}'.format(d=device_index))
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
     try:
-        result = run_command(command)
-    except CommandError:
+        ifreq = fcntl.ioctl(sock.fileno(), SIOCGIFHWADDR, struct.pack('256s', device))
+    except IOError:
         _, ex, trace = sys.exc_info()
-        log.error('There was a problem running command, unable to determine mac address: {c}\n{e}'.format(
-                c=command, e=str(ex)))
+        log.info('mac address not found for device: {d}\n{e}'.format(d=device_index, e=str(ex)))
         return
-    ipaddr = result['output'].split()
-    get_next = False
-    mac_address = None
-    for part in ipaddr:
-        if get_next:
-            mac_address = part
-            log.info('Found mac address: {m}'.format(m=mac_address))
-            break
-        if 'link' in part:
-            get_next = True
-    if not mac_address:
-        log.info('mac address not found for device: {d}'.format(d=device_index))
+    finally:
+        sock.close()
+    mac_address = ':'.join('{b:02x}'.format(b=ord(b)) for b in ifreq[18:24])
+    log.info('Found mac address: {m}'.format(m=mac_address))
     return mac_address
 
 
@@ -312,14 +630,8 @@ def chmod(path, mode, recursive=False):
     log = logging.getLogger(mod_logger + '.chmod')
 
     # Validate args
-    if not isinstance(path, basestring):
-        msg = 'path argument is not a string'
-        log.error(msg)
-        raise CommandError(msg)
-    if not isinstance(mode, basestring):
-        msg = 'mode argument is not a string'
-        log.error(msg)
-        raise CommandError(msg)
+    _require_str(log, 'path', path, error=CommandError)
+    _require_str(log, 'mode', mode, error=CommandError)
 
     # Ensure the item exists
     if not os.path.exists(path):
@@ -350,10 +662,7 @@ def mkdir_p(path):
     :raises CommandError
     """
     log = logging.getLogger(mod_logger + '.mkdir_p')
-    if not isinstance(path, basestring):
-        msg = 'path argument is not a string'
-        log.error(msg)
-        raise CommandError(msg)
+    _require_str(log, 'path', path, error=CommandError)
     log.info('Attempting to create directory: %s', path)
     try:
         os.makedirs(path)
@@ -366,6 +675,42 @@ def mkdir_p(path):
             raise CommandError(msg)
 
 
+def _read_simple_env_script(script):
+    """Reads the variables a script exports when it contains only
+    comments and simple assignments
+
+    Assignments without export only change variables that are already
+    in the environment, as they would in a shell.
+
+    :param script: (str) Full path to the script
+    :return: (dict) of exported variables, or None if the script needs
+        a shell to evaluate
+    """
+    try:
+        with open(script, 'r') as f:
+            lines = f.readlines()
+    except (IOError, OSError):
+        return
+    env = {}
+    for line in lines:
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        match = simple_assignment_regex.match(line)
+        if not match or shell_special_chars.intersection(match.group(3)):
+            return
+        try:
+            value = shlex.split(match.group(3))
+        except ValueError:
+            return
+        if len(value) > 1:
+            return
+        name = match.group(2)
+        if match.group(1) or name in os.environ or name in env:
+            env[name] = value[0] if value else ''
+    return env
+
+
 def source(script):
     """Emulates 'source' command in bash
 
@@ -374,13 +719,17 @@ def source(script):
     :raises CommandError
     """
     log = logging.getLogger(mod_logger + '.source')
-    if not isinstance(script, basestring):
-        msg = 'script argument must be a string'
-        log.error(msg)
-        raise CommandError(msg)
+    _require_str(log, 'script', script, error=CommandError)
     log.info('Attempting to source script: %s', script)
+    exported = _read_simple_env_script(script)
+    if exported is not None:
+        log.debug('Script contains only simple assignments, read without a shell: %s', script)
+        env = dict(os.environ)
+        env.update(exported)
+        os.environ.update(exported)
+        return env
     try:
-        pipe = subprocess.Popen(". %s; env" % script, stdout=subprocess.PIPE, shell=True)
+        pipe = subprocess.Popen(". %s >/dev/null; env -0" % script, stdout=subprocess.PIPE, shell=True)
         data = pipe.communicate()[0]
     except ValueError:
         _, ex, trace = sys.exc_info()
@@ -399,20 +748,16 @@ def source(script):
         raise CommandError, msg, trace
     env = {}
     log.debug('Adding environment variables from data: {d}'.format(d=data))
-    for line in data.splitlines():
-        entry = line.split("=", 1)
-        if len(entry) != 2:
-            log.warn('This property is not in prop=value format, and will be skipped: {p}'.format(p=line))
+    # Entries are NUL delimited so values may contain newlines
+    for entry in data.split('\0'):
+        if not entry:
             continue
-        try:
-            env[entry[0]] = entry[1]
-        except IndexError:
-            _, ex, trace = sys.exc_info()
-            log.warn('IndexError: There was a problem setting environment variables from line: {p}\n{e}'.format(
-                p=line, e=str(ex)))
+        name, sep, value = entry.partition('=')
+        if not sep:
+            log.warn('This property is not in prop=value format, and will be skipped: {p}'.format(p=entry))
             continue
-        else:
-            log.debug('Added environment variable {p}={v}'.format(p=entry[0], v=entry[1]))
+        env[name] = value
+        log.debug('Added environment variable {p}={v}'.format(p=name, v=value))
     os.environ.update(env)
     return env
 
@@ -432,10 +777,7 @@ def yum_update(downloadonly=False, dest_dir='/tmp'):
     log = logging.getLogger(mod_logger + '.yum_update')
 
     # Type checks on the args
-    if not isinstance(dest_dir, basestring):
-        msg = 'dest_dir argument must be a string'
-        log.error(msg)
-        raise CommandError(msg)
+    _require_str(log, 'dest_dir', dest_dir, error=CommandError)
     if not isinstance(downloadonly, bool):
         msg = 'downloadonly argument must be a bool'
         log.error(msg)
@@ -473,6 +815,28 @@ def yum_update(downloadonly=False, dest_dir='/tmp'):
     return result['code']
 
 
+def _get_missing_packages(packages):
+    """Determines which of a list of packages are not installed using
+    a single rpm query
+
+    :param packages: List of package names (str)
+    :return: List of the package names that rpm does not report as
+        installed, or all packages if rpm could not be queried
+    """
+    log = logging.getLogger(mod_logger + '._get_missing_packages')
+    try:
+        result = run_command(['rpm', '-q', '--queryformat', '%{NAME}\\n'] + packages, print_output=False)
+    except CommandError:
+        _, ex, trace = sys.exc_info()
+        log.warn('Unable to query installed packages, all packages will be installed\n{e}'.format(e=str(ex)))
+        return packages
+    # Installed packages are reported by name, anything else (versions, files, groups) is left to yum
+    installed = set(line.strip() for line in result['output'].splitlines())
+    missing = [p for p in packages if p not in installed]
+    log.info('Found {n} of {t} packages not yet installed'.format(n=len(missing), t=len(packages)))
+    return missing
+
+
 def yum_install(packages, downloadonly=False, dest_dir='/tmp'):
     """Installs (or downloads) a list of packages from yum
 
@@ -490,10 +854,7 @@ def yum_install(packages, downloadonly=False, dest_dir='/tmp'):
     log = logging.getLogger(mod_logger + '.yum_install')
 
     # Type checks on the args
-    if not isinstance(dest_dir, basestring):
-        msg = 'dest_dir argument must be a string'
-        log.error(msg)
-        raise CommandError(msg)
+    _require_str(log, 'dest_dir', dest_dir, error=CommandError)
     if not isinstance(packages, list):
         msg = 'packages argument must be a list'
         log.error(msg)
@@ -513,6 +874,13 @@ def yum_install(packages, downloadonly=False, dest_dir='/tmp'):
             log.error(msg)
             raise CommandError(msg)
 
+    # Skip packages that are already installed, yum is slow to start even when there is nothing to do
+    if not downloadonly:
+        packages = _get_missing_packages(packages)
+        if not packages:
+            log.info('All packages are already installed, nothing to do')
+            return 0
+
     # Build the yum install command string
     command = ['yum', '-y', 'install'] + packages
 
@@ -556,10 +924,7 @@ def rpm_install(install_dir):
     log = logging.getLogger(mod_logger + '.rpm_install')
 
     # Type checks on the args
-    if not isinstance(install_dir, basestring):
-        msg = 'install_dir argument must be a string'
-        log.error(msg)
-        raise CommandError(msg)
+    _require_str(log, 'install_dir', install_dir, error=CommandError)
 
     # Ensure the install_dir directory exists
     if not os.path.isdir(install_dir):
@@ -567,8 +932,15 @@ def rpm_install(install_dir):
         log.error(msg)
         raise CommandError(msg)
 
+    # Find the RPM files, the command is not run through a shell so expand the glob here
+    rpm_files = sorted(glob.glob(os.path.join(install_dir, '*.rpm')))
+    if not rpm_files:
+        msg = 'No RPM files found in directory: {d}'.format(d=install_dir)
+        log.error(msg)
+        raise CommandError(msg)
+
     # Create the command
-    command = ['rpm', '-iv', '--force', '{d}/*.rpm'.format(d=install_dir)]
+    command = ['rpm', '-iv', '--force'] + rpm_files
 
     # Run the rpm command
     try:
@@ -580,13 +952,48 @@ def rpm_install(install_dir):
     return result['code']
 
 
+def _write_file_atomic(file_path, contents):
+    """Replaces the contents of a file by writing a temp file in the
+    same directory and renaming it over the original
+
+    :param file_path: (str) Full path to the file to write
+    :param contents: (str) New contents of the file
+    :return: None
+    :raises: IOError, OSError
+    """
+    f = tempfile.NamedTemporaryFile(
+        mode='w', dir=os.path.dirname(file_path) or '.', prefix='.pycons3rt-', delete=False)
+    tmp_file = f.name
+    renamed = False
+    try:
+        with f:
+            f.write(contents)
+            # Flush to disk before the rename so a crash cannot leave an empty file in place
+            f.flush()
+            os.fsync(f.fileno())
+        if os.path.exists(file_path):
+            shutil.copymode(file_path, tmp_file)
+        else:
+            os.chmod(tmp_file, 0644)
+        os.rename(tmp_file, file_path)
+        renamed = True
+    finally:
+        # Remove the temp file on any failure, keeping the original error
+        if not renamed:
+            try:
+                os.remove(tmp_file)
+            except OSError:
+                pass
+
+
 def sed(file_path, pattern, replace_str, g=0):
     """Python impl of the bash sed command
 
     This method emulates the functionality of a bash sed command.
 
     :param file_path: (str) Full path to the file to be edited
-    :param pattern: (str) Search pattern to replace as a regex
+    :param pattern: (str) Search pattern to replace as a regex, or
+        a compiled regex
     :param replace_str: (str) String to replace the pattern
     :param g: (int) Whether to globally replace (0) or replace 1
         instance (equivalent to the 'g' option in bash sed
@@ -596,18 +1003,12 @@ def sed(file_path, pattern, replace_str, g=0):
     log = logging.getLogger(mod_logger + '.sed')
 
     # Type checks on the args
-    if not isinstance(file_path, basestring):
-        msg = 'file_path argument must be a string'
-        log.error(msg)
-        raise CommandError(msg)
-    if not isinstance(pattern, basestring):
-        msg = 'pattern argument must be a string'
-        log.error(msg)
-        raise CommandError(msg)
-    if not isinstance(replace_str, basestring):
-        msg = 'replace_str argument must be a string'
+    _require_str(log, 'file_path', file_path, error=CommandError)
+    if not isinstance(pattern, basestring) and not hasattr(pattern, 'subn'):
+        msg = 'pattern argument must be a string or compiled regex'
         log.error(msg)
         raise CommandError(msg)
+    _require_str(log, 'replace_str', replace_str, error=CommandError)
 
     # Ensure the file_path file exists
     if not os.path.isfile(file_path):
@@ -615,16 +1016,20 @@ def sed(file_path, pattern, replace_str, g=0):
         log.error(msg)
         raise CommandError(msg)
 
-    # Search for a matching pattern and replace matching patterns
+    # Search for a matching pattern and replace matching patterns line by line
     log.info('Updating file: %s...', file_path)
-    for line in fileinput.input(file_path, inplace=True):
-        if re.search(pattern, line):
-            log.info('Updating line: %s', line)
-            new_line = re.sub(pattern, replace_str, line, count=g)
-            log.info('Replacing with line: %s', new_line)
-            sys.stdout.write(new_line)
-        else:
-            sys.stdout.write(line)
+    compiled_pattern = pattern if hasattr(pattern, 'subn') else re.compile(pattern)
+    with open(file_path, 'r') as f:
+        lines = f.readlines()
+    num_updated = 0
+    for i, line in enumerate(lines):
+        new_line, num_subs = compiled_pattern.subn(replace_str, line, count=g)
+        if num_subs:
+            lines[i] = new_line
+            num_updated += 1
+    if num_updated:
+        _write_file_atomic(file_path, ''.join(lines))
+    log.info('Updated {n} lines in file: {f}'.format(n=num_updated, f=file_path))
 
 
 def zip_dir(dir_path, zip_file):
@@ -641,14 +1046,8 @@ def zip_dir(dir_path, zip_file):
     log = logging.getLogger(mod_logger + '.zip_dir')
 
     # Validate args
-    if not isinstance(dir_path, basestring):
-        msg = 'dir_path argument must be a string'
-        log.error(msg)
-        raise CommandError(msg)
-    if not isinstance(zip_file, basestring):
-        msg = 'zip_file argument must be a string'
-        log.error(msg)
-        raise CommandError(msg)
+    _require_str(log, 'dir_path', dir_path, error=CommandError)
+    _require_str(log, 'zip_file', zip_file, error=CommandError)
 
     # Ensure the dir_path file exists
     if not os.path.isdir(dir_path):
@@ -656,12 +1055,13 @@ def zip_dir(dir_path, zip_file):
         log.error(msg)
         raise CommandError(msg)
 
+    # Length of the dir_path prefix removed from each archive name, the same for every file
+    strip = len(dir_path) - len(os.path.split(dir_path)[-1])
     try:
-        with contextlib.closing(zipfile.ZipFile(zip_file, 'w', allowZip64=True)) as zip_w:
+        with zipfile.ZipFile(zip_file, 'w', zipfile.ZIP_DEFLATED, allowZip64=True) as zip_w:
             for root, dirs, files in os.walk(dir_path):
                 for f in files:
                     log.debug('Adding file to zip: %s', f)
-                    strip = len(dir_path) - len(os.path.split(dir_path)[-1])
                     file_name = os.path.join(root, f)
                     archive_name = os.path.join(root[strip:], f)
                     zip_w.write(file_name, archive_name)
@@ -674,6 +1074,73 @@ def zip_dir(dir_path, zip_file):
     log.info('Successfully created zip file: %s', zip_file)
 
 
+def get_interface_ip(interface_name):
+    """Gets the IPv4 address assigned to a network interface
+    directly from the kernel
+
+    :param interface_name: (str) Name of the interface (e.g. eth0)
+    :return: (str) IP address
+    :raises: IOError if the interface does not exist or has no address
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        ifreq = fcntl.ioctl(sock.fileno(), SIOCGIFADDR, struct.pack('256s', interface_name[:15]))
+    finally:
+        sock.close()
+    return socket.inet_ntoa(ifreq[20:24])
+
+
+def _wait_for_interface_up(interface_name, timeout_sec=10.0, poll_interval_sec=1.0):
+    """Waits for a network interface to have an IPv4 address
+
+    Sleeps on rtnetlink link and address notifications when available
+    and re-checks the interface when one arrives, otherwise polls every
+    poll_interval_sec.
+
+    :param interface_name: (str) Name of the interface (e.g. eth0)
+    :param timeout_sec: (float) seconds to wait
+    :param poll_interval_sec: (float) maximum seconds between checks
+    :return: (bool) True if the interface came up before the timeout
+    """
+    log = logging.getLogger(mod_logger + '._wait_for_interface_up')
+    try:
+        nl = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, socket.NETLINK_ROUTE)
+        nl.bind((0, RTMGRP_LINK | RTMGRP_IPV4_IFADDR))
+    except (AttributeError, socket.error):
+        _, ex, _ = sys.exc_info()
+        log.debug('rtnetlink not available, polling interface %s: %s', interface_name, ex)
+        nl = None
+    deadline = time.time() + timeout_sec
+    try:
+        while True:
+            try:
+                get_interface_ip(interface_name)
+            except (IOError, OSError):
+                pass
+            else:
+                log.debug('Interface %s is up', interface_name)
+                return True
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return False
+            wait_sec = min(remaining, poll_interval_sec)
+            if nl is None:
+                time.sleep(wait_sec)
+                continue
+            # Any notification is just a wake up, drain them and check the interface again
+            try:
+                readable = select.select([nl], [], [], wait_sec)[0]
+                while readable:
+                    nl.recv(65536)
+                    readable = select.select([nl], [], [], 0)[0]
+            except (select.error, socket.error):
+                time.sleep(wait_sec)
+    finally:
+        if nl is not None:
+            nl.close()
+
+
+@_interface_cache
 def get_ip(interface=0):
     """This method return the IP address
 
@@ -689,32 +1156,15 @@ def get_ip(interface=0):
         ip_address = socket.gethostbyname(socket.gethostname())
     except socket.error:
         log.info('Unable to get IP address for this system using hostname, '
-                 'using a bash command...')
-        command = 'ip addr show eth%s | grep inet | grep -v inet6 | ' \
-                  'awk \'{ print $2 }\' | cut -d/ -f1 ' \
-                  '>> /root/ip' % interface
+                 'querying interface eth%s...', interface)
         try:
-            log.info('Running command: %s', command)
-            subprocess.check_call(command, shell=True)
-        except(OSError, subprocess.CalledProcessError):
+            ip_address = get_interface_ip('eth{n}'.format(n=interface))
+        except (IOError, OSError):
             _, ex, trace = sys.exc_info()
             msg = 'Unable to get the IP address of this system\n{e}'.format(
                 e=str(ex))
             log.error(msg)
             raise CommandError, msg, trace
-        else:
-            ip_file = '/root/ip'
-            log.info('Command executed successfully, pulling IP address from '
-                     'file: %s', ip_file)
-            if os.path.isfile(ip_file):
-                with open(ip_file, 'r') as f:
-                    for line in f:
-                        ip_address = line.strip()
-                        log.info('Found IP address from file: %s', ip_address)
-            else:
-                msg = 'File not found: {f}'.format(f=ip_file)
-                log.error(msg)
-                raise CommandError(msg)
     log.info('Returning IP address: %s', ip_address)
     return ip_address
 
@@ -733,14 +1183,8 @@ def update_hosts_file(ip, entry):
     log = logging.getLogger(mod_logger + '.update_hosts_file')
 
     # Validate args
-    if not isinstance(ip, basestring):
-        msg = 'ip argument must be a string'
-        log.error(msg)
-        raise CommandError(msg)
-    if not isinstance(entry, basestring):
-        msg = 'entry argument must be a string'
-        log.error(msg)
-        raise CommandError(msg)
+    _require_str(log, 'ip', ip, error=CommandError)
+    _require_str(log, 'entry', entry, error=CommandError)
 
     # Ensure the file_path file exists
     hosts_file = '/etc/hosts'
@@ -752,28 +1196,31 @@ def update_hosts_file(ip, entry):
     # Updating /etc/hosts file
     log.info('Updating hosts file: {f} with IP {i} and entry: {e}'.format(f=hosts_file, i=ip, e=entry))
     full_entry = ip + ' ' + entry.strip() + '\n'
+    with open(hosts_file, 'r') as f:
+        lines = f.readlines()
     updated = False
-    for line in fileinput.input(hosts_file, inplace=True):
-        if re.search(ip, line):
-            if line.split()[0] == ip:
-                log.info('Found IP {i} in line: {li}, updating...'.format(i=ip, li=line))
-                log.info('Replacing with new line: {n}'.format(n=full_entry))
-                sys.stdout.write(full_entry)
+    for line_num, line in enumerate(lines):
+        if ip in line:
+            parts = line.split()
+            if parts and parts[0] == ip:
+                log.info('Found IP {i} in line: {li}, replacing with new line: {n}'.format(
+                    i=ip, li=line, n=full_entry))
+                lines[line_num] = full_entry
                 updated = True
-            else:
-                log.debug('Found ip {i} in line {li} but not an exact match, adding line back to hosts file {f}...'.
-                          format(i=ip, li=line, f=hosts_file))
-                sys.stdout.write(line)
-        else:
-            log.debug('IP address {i} not found in line, adding line back to hosts file {f}: {li}'.format(
-                    i=ip, li=line, f=hosts_file))
-            sys.stdout.write(line)
 
-    # Append the entry if the hosts file was not updated
-    if updated is False:
-        with open(hosts_file, 'a') as f:
-            log.info('Appending hosts file entry to {f}: {e}'.format(f=hosts_file, e=full_entry))
-            f.write(full_entry)
+    # Append the entry when the IP was not found, then rewrite the hosts file once
+    if not updated:
+        log.info('Appending hosts file entry to {f}: {e}'.format(f=hosts_file, e=full_entry))
+        if lines and not lines[-1].endswith('\n'):
+            lines[-1] += '\n'
+        lines.append(full_entry)
+    try:
+        _write_file_atomic(hosts_file, ''.join(lines))
+    except (IOError, OSError):
+        _, ex, trace = sys.exc_info()
+        msg = 'Unable to update file: {f}\n{e}'.format(f=hosts_file, e=str(ex))
+        log.error(msg)
+        raise CommandError, msg, trace
 
 
 def set_hostname(new_hostname, pretty_hostname=None):
@@ -791,16 +1238,14 @@ def set_hostname(new_hostname, pretty_hostname=None):
     log = logging.getLogger(mod_logger + '.set_hostname')
 
     # Ensure the hostname is a str
-    if not isinstance(new_hostname, basestring):
-        msg = 'new_hostname argument must be a string'
-        raise CommandError(msg)
+    _require_str(log, 'new_hostname', new_hostname, error=CommandError)
 
     # Update the network config file
     network_file = '/etc/sysconfig/network'
     if os.path.isfile(network_file):
         log.info('Updating {f} with the new hostname: {h}...'.format(f=network_file, h=new_hostname))
         try:
-            sed(network_file, '^HOSTNAME=.*', 'HOSTNAME=' + new_hostname)
+            sed(network_file, hostname_regex, 'HOSTNAME=' + new_hostname)
         except CommandError:
             _, ex, trace = sys.exc_info()
             msg = 'Unable to update [{f}], produced output:\n{e}'.format(f=network_file, e=str(ex))
@@ -814,24 +1259,23 @@ def set_hostname(new_hostname, pretty_hostname=None):
         pretty_hostname_file = '/etc/machine-info'
         log.info('This is systemd, updating files: {h} and {p}'.format(h=hostname_file, p=pretty_hostname_file))
 
-        # Update the hostname file
-        log.info('Updating hostname file: {h}...'.format(h=hostname_file))
-        if os.path.isfile(hostname_file):
-            os.remove(hostname_file)
-        with open(hostname_file, 'w') as f:
-            f.write(new_hostname)
-        log.info('Updating pretty hostname file: {p}'.format(p=pretty_hostname_file))
-
         # Use the same thing if pretty hostname is not provided
         if pretty_hostname is None:
-            log.info('Pretty hostname not provided, using: {p}'.format(p=pretty_hostname))
+            log.info('Pretty hostname not provided, using: {p}'.format(p=new_hostname))
             pretty_hostname = new_hostname
 
-        # Update the pretty hostname file
-        if os.path.isfile(pretty_hostname_file):
-            os.remove(pretty_hostname_file)
-        with open(pretty_hostname_file, 'w') as f:
-            f.write('PRETTY_HOSTNAME={p}'.format(p=pretty_hostname))
+        # Replace the hostname and pretty hostname files atomically
+        try:
+            log.info('Updating hostname file: {h}...'.format(h=hostname_file))
+            _write_file_atomic(hostname_file, new_hostname)
+            log.info('Updating pretty hostname file: {p}'.format(p=pretty_hostname_file))
+            _write_file_atomic(pretty_hostname_file, 'PRETTY_HOSTNAME={p}'.format(p=pretty_hostname))
+        except (IOError, OSError):
+            _, ex, trace = sys.exc_info()
+            msg = 'Unable to update the hostname files\n{e}'.format(e=str(ex))
+            log.error(msg)
+            raise CommandError, msg, trace
+        clear_ip_addr_cache()
         return 0
     else:
         command = ['/bin/hostname', new_hostname]
@@ -844,6 +1288,7 @@ def set_hostname(new_hostname, pretty_hostname=None):
             raise
         log.info('Hostname command completed with code: {c} and output:\n{o}'.format(
             c=result['code'], o=result['output']))
+        clear_ip_addr_cache()
         return result['code']
 
 
@@ -857,28 +1302,26 @@ def set_ntp_server(server):
     log = logging.getLogger(mod_logger + '.set_ntp_server')
 
     # Ensure the hostname is a str
-    if not isinstance(server, basestring):
-        msg = 'server argument must be a string'
-        log.error(msg)
-        raise CommandError(msg)
+    _require_str(log, 'server', server, error=CommandError)
     # Ensure the ntp.conf file exists
     ntp_conf = '/etc/ntp.conf'
     if not os.path.isfile(ntp_conf):
         msg = 'File not found: {f}'.format(f=ntp_conf)
         log.error(msg)
         raise CommandError(msg)
-    log.info('Clearing out existing server entries from %s...', ntp_conf)
+    # Replace the existing server entries with the new server in a single rewrite
+    out_str = 'server ' + server
+    log.info('Replacing existing server entries in {f} with: {s}'.format(f=ntp_conf, s=out_str))
     try:
-        sed(ntp_conf, '^server.*', '', g=0)
-    except CommandError:
+        with open(ntp_conf, 'r') as f:
+            lines = [line for line in f if not ntp_server_regex.match(line)]
+        contents = ''.join(lines).rstrip('\n') + '\n' + out_str + '\n'
+        _write_file_atomic(ntp_conf, contents)
+    except (IOError, OSError):
         _, ex, trace = sys.exc_info()
         msg = 'Unable to update file: {f}\n{e}'.format(f=ntp_conf, e=str(ex))
         log.error(msg)
         raise CommandError, msg, trace
-    out_str = 'server ' + server
-    log.info('Appending server: %s', out_str)
-    with open(ntp_conf, 'a') as f:
-        f.write(out_str)
     log.info('Successfully updated file: {f}'.format(f=ntp_conf))
 
 
@@ -892,14 +1335,8 @@ def copy_ifcfg_file(source_interface, dest_interface):
     """
     log = logging.getLogger(mod_logger + '.copy_ifcfg_file')
     # Validate args
-    if not isinstance(source_interface, basestring):
-        msg = 'source_interface argument must be a string'
-        log.error(msg)
-        raise TypeError(msg)
-    if not isinstance(dest_interface, basestring):
-        msg = 'dest_interface argument must be a string'
-        log.error(msg)
-        raise TypeError(msg)
+    _require_str(log, 'source_interface', source_interface)
+    _require_str(log, 'dest_interface', dest_interface)
 
     network_script = '/etc/sysconfig/network-scripts/ifcfg-eth'
     source_file = network_script + source_interface
@@ -922,7 +1359,7 @@ def copy_ifcfg_file(source_interface, dest_interface):
 
     # Updating the destination network script DEVICE property
     try:
-        sed(file_path=dest_file, pattern='^DEVICE=.*',
+        sed(file_path=dest_file, pattern=device_regex,
             replace_str='DEVICE="eth{i}"'.format(i=dest_interface))
     except CommandError:
         _, ex, trace = sys.exc_info()
@@ -932,8 +1369,7 @@ def copy_ifcfg_file(source_interface, dest_interface):
         raise CommandError, msg, trace
     log.info('Successfully created file: {d}'.format(d=dest_file))
 
-    log.info('Restarting networking in 10 seconds to ensure the changes take effect...')
-    time.sleep(10)
+    interface_name = 'eth{d}'.format(d=dest_interface)
     retry_time = 10
     max_retries = 10
     for i in range(1, max_retries+2):
@@ -952,6 +1388,12 @@ def copy_ifcfg_file(source_interface, dest_interface):
         else:
             log.info('Successfully restarted networking')
             break
+
+    # Wait for the interface to come up rather than sleeping a fixed time
+    if _wait_for_interface_up(interface_name, timeout_sec=retry_time):
+        log.info('Interface {n} is up'.format(n=interface_name))
+    else:
+        log.warn('Interface {n} did not come up within {t} seconds'.format(n=interface_name, t=retry_time))
     log.info('Successfully configured interface: {d}'.format(d=dest_interface))
 
 
@@ -964,14 +1406,8 @@ def remove_ifcfg_file(device_index='0'):
     :raises CommandError
     """
     log = logging.getLogger(mod_logger + '.remove_ifcfg_file')
-    if not isinstance(device_index, basestring):
-        msg = 'device_index argument must be a string'
-        log.error(msg)
-        raise CommandError(msg)
+    _require_str(log, 'device_index', device_index, error=CommandError)
     network_script = '/etc/sysconfig/network-scripts/ifcfg-eth{d}'.format(d=device_index)
-    if not os.path.isfile(network_script):
-        log.info('File does not exist, nothing will be removed: {n}'.format(n=network_script))
-        return
 
     # Remove the network config script
     log.info('Attempting to remove file: {n}'.format(n=network_script))
@@ -979,6 +1415,9 @@ def remove_ifcfg_file(device_index='0'):
         os.remove(network_script)
     except(IOError, OSError):
         _, ex, trace = sys.exc_info()
+        if ex.errno == errno.ENOENT:
+            log.info('File does not exist, nothing will be removed: {n}'.format(n=network_script))
+            return
         msg = 'There was a problem removing network script file: {n}\n{e}'.format(n=network_script, e=str(ex))
         log.error(msg)
         raise OSError, msg, trace
@@ -998,82 +1437,202 @@ def remove_ifcfg_file(device_index='0'):
         log.info('Successfully restarted the network service')
 
 
-def add_nat_rule(port, source_interface, dest_interface):
-    """Adds a NAT rule to iptables
+def _cached_ip_addresses():
+    """Returns the ip_addr device addresses, re-using the result of a
+    recent call so repeated NAT rule additions do not re-query
 
-    :param port: String or int port number
-    :param source_interface: String (e.g. 1)
-    :param dest_interface: String (e.g. 0:0)
+    :return: (dict) Containing device: ip_address
+    :raises CommandError
+    """
+    now = time.time()
+    if _nat_ip_addresses_cache['ip_addresses'] is None or \
+            now - _nat_ip_addresses_cache['timestamp'] >= nat_ip_addresses_ttl_sec:
+        _nat_ip_addresses_cache['ip_addresses'] = ip_addr()
+        _nat_ip_addresses_cache['timestamp'] = now
+    return _nat_ip_addresses_cache['ip_addresses']
+
+
+def _append_nat_rules(rules):
+    """Appends NAT rules to the running iptables without saving
+
+    :param rules: (list) of (port, source_interface, destination_ip)
+        tuples
     :return: None
-    :raises: TypeError, OSError
+    :raises: OSError
     """
-    log = logging.getLogger(mod_logger + '.add_nat_rule')
-    # Validate args
-    if not isinstance(source_interface, basestring):
-        msg = 'source_interface argument must be a string'
-        log.error(msg)
-        raise TypeError(msg)
-    if not isinstance(dest_interface, basestring):
-        msg = 'dest_interface argument must be a string'
-        log.error(msg)
-        raise TypeError(msg)
+    log = _append_nat_rules_log
 
-    ip_addresses = ip_addr()
-    destination_ip = ip_addresses['eth{i}'.format(i=dest_interface)]
-    log.info('Using destination IP address: {d}'.format(d=destination_ip))
+    # Add the rules through libiptc when available to avoid running iptables
+    if iptc is not None:
+        chain = iptc.Chain(iptc.Table(iptc.Table.NAT), 'PREROUTING')
+        for port, source_interface, destination_ip in rules:
+            try:
+                rule = iptc.Rule()
+                rule.in_interface = 'eth{s}'.format(s=source_interface)
+                rule.protocol = 'tcp'
+                match = rule.create_match('tcp')
+                match.dport = str(port)
+                target = rule.create_target('DNAT')
+                target.to_destination = '{d}:{p}'.format(p=port, d=destination_ip)
+                chain.append_rule(rule)
+            except iptc.IPTCError:
+                _, ex, trace = sys.exc_info()
+                msg = 'There was a problem adding NAT rule for port {p} with python-iptables\n{e}'.format(
+                    p=port, e=str(ex))
+                log.error(msg)
+                raise OSError, msg, trace
+            log.info('Successfully added NAT rule for port %s to %s', port, destination_ip)
+        return
 
-    command = ['iptables', '-t', 'nat', '-A', 'PREROUTING', '-i',
-               'eth{s}'.format(s=source_interface), '-p', 'tcp',
-               '--dport', str(port), '-j', 'DNAT', '--to',
-               '{d}:{p}'.format(p=port, d=destination_ip)]
-    log.info('Running command: {c}'.format(c=command))
+    # Otherwise append all the rules with a single iptables-restore that keeps the existing rules
+    rules_text = '*nat\n'
+    for port, source_interface, destination_ip in rules:
+        rules_text += '-A PREROUTING -i eth{s} -p tcp --dport {p} -j DNAT --to {d}:{p}\n'.format(
+            s=source_interface, p=port, d=destination_ip)
+    rules_text += 'COMMIT\n'
+    command = iptables_restore_command
+    log.info('Running command %s with rules:\n%s', ' '.join(command), rules_text)
     try:
-        subprocess.check_call(command)
-    except OSError:
+        result = run_command(command, timeout_sec=20, input=rules_text)
+    except CommandError:
         _, ex, trace = sys.exc_info()
-        msg = 'There was a problem running command: {c}\n{e}'.format(c=command, e=str(ex))
+        msg = 'There was a problem running command: {c}\n{e}'.format(c=' '.join(command), e=str(ex))
         log.error(msg)
         raise OSError, msg, trace
-    except subprocess.CalledProcessError:
-        _, ex, trace = sys.exc_info()
-        msg = 'Command returned a non-zero exit code: {c}\n{e}'.format(c=command, e=str(ex))
+    if result['code'] != 0:
+        msg = 'Command {c} exited with code {r} and output:\n{o}'.format(
+            c=' '.join(command), r=result['code'], o=result['output'])
         log.error(msg)
-        raise OSError, msg, trace
-    else:
-        log.info('Successfully ran command: {c}'.format(c=command))
+        raise OSError(msg)
+    log.info('Successfully added %s NAT rules', len(rules))
 
-    # Save the iptables with the new NAT rule
+
+def add_nat_rules(rules, save=True):
+    """Adds a list of NAT rules to iptables and saves the rules once
+
+    :param rules: (list) of (port, source_interface, dest_interface)
+        tuples as accepted by add_nat_rule, optionally with the
+        destination IP address as a fourth item
+    :param save: (bool) True to save the iptables rules after adding,
+        pass False and call save_iptables once when adding rules in
+        several calls
+    :return: None
+    :raises: TypeError, OSError
+    """
+    log = _add_nat_rules_log
+    # Validate args
+    if not isinstance(rules, list):
+        msg = 'rules argument must be a list'
+        log.error(msg)
+        raise TypeError(msg)
+    for rule in rules:
+        _require_str(log, 'source_interface', rule[1])
+        _require_str(log, 'dest_interface', rule[2])
+
+    # Look up the interface addresses only when a rule does not provide its destination IP
+    ip_addresses = None
+    resolved_rules = []
+    for rule in rules:
+        port, source_interface, dest_interface = rule[:3]
+        destination_ip = rule[3] if len(rule) > 3 else None
+        if destination_ip is None:
+            if ip_addresses is None:
+                ip_addresses = _cached_ip_addresses()
+            destination_ip = ip_addresses['eth{i}'.format(i=dest_interface)]
+        log.info('Using destination IP address: %s', destination_ip)
+        resolved_rules.append((port, source_interface, destination_ip))
+    _append_nat_rules(resolved_rules)
+
+    if not save:
+        return
+
+    # Save the iptables with the new NAT rules
     try:
         save_iptables()
     except OSError:
         _, ex, trace = sys.exc_info()
         msg = 'OSError: There was a problem saving iptables rules\n{e}'.format(e=str(ex))
         raise OSError, msg, trace
-    log.info('Successfully saved iptables rules with the NAT rule')
+    log.info('Successfully saved iptables rules with %s NAT rules', len(rules))
 
 
-def service_network_restart():
+def add_nat_rule(port, source_interface, dest_interface, save=True, destination_ip=None):
+    """Adds a NAT rule to iptables
+
+    :param port: String or int port number
+    :param source_interface: String (e.g. 1)
+    :param dest_interface: String (e.g. 0:0)
+    :param save: (bool) True to save the iptables rules after adding,
+        pass False when adding several rules and call save_iptables
+        once afterwards
+    :param destination_ip: (str) IP address of the destination
+        interface, looked up from dest_interface when None
+    :return: None
+    :raises: TypeError, OSError
+    """
+    add_nat_rules([(port, source_interface, dest_interface, destination_ip)], save=save)
+
+
+def _wait_for_service_state(status_command, active=True, timeout_sec=15.0, poll_interval_sec=0.25):
+    """Polls a service status command until it reports the desired
+    state or the timeout expires
+
+    :param status_command: (list) command that exits 0 when the
+        service is active
+    :param active: (bool) True to wait for the service to be active,
+        False to wait for it to be inactive
+    :param timeout_sec: (float) maximum seconds to wait
+    :param poll_interval_sec: (float) seconds between status checks
+    :return: (bool) True if the service reached the desired state
+    """
+    deadline = time.time() + timeout_sec
+    with open(os.devnull, 'w') as devnull:
+        while True:
+            try:
+                code = subprocess.call(status_command, stdout=devnull, stderr=devnull)
+            except OSError:
+                return False
+            if (code == 0) == active:
+                return True
+            if time.time() >= deadline:
+                return False
+            time.sleep(poll_interval_sec)
+
+
+def service_network_restart(settle_sec=0):
     """Restarts the network service on linux
+
+    :param settle_sec: (float) additional seconds to wait after the
+        network service reports it is up, legacy behavior was 5
     :return: None
     :raises CommandError
     """
     log = logging.getLogger(mod_logger + '.service_network_restart')
     command = ['service', 'network', 'restart']
-    time.sleep(5)
     try:
         result = run_command(command)
-        time.sleep(5)
         code = result['code']
     except CommandError:
         raise
-    log.info('Network restart produced output:\n{o}'.format(o=result['output']))
+    finally:
+        clear_ip_addr_cache()
+    log.info('Network restart produced output:\n%s', result['output'])
 
     if code != 0:
         msg = 'Network services did not restart cleanly, exited with code: {c}'.format(c=code)
         log.error(msg)
         raise CommandError(msg)
+
+    # Wait for the network service to report that it is up, systemctl answers without running the init script
+    if is_systemd():
+        status_command = ['systemctl', 'is-active', '--quiet', 'network']
     else:
-        log.info('Successfully restarted networking!')
+        status_command = ['service', 'network', 'status']
+    if not _wait_for_service_state(status_command):
+        log.warn('Network service did not report an active status after restarting')
+    if settle_sec:
+        time.sleep(settle_sec)
+    log.info('Successfully restarted networking!')
 
 
 def save_iptables(rules_file='/etc/sysconfig/iptables'):
@@ -1082,10 +1641,10 @@ def save_iptables(rules_file='/etc/sysconfig/iptables'):
     :return: None
     :raises OSError
     """
-    log = logging.getLogger(mod_logger + '.save_iptables')
+    log = _save_iptables_log
 
     # Run iptables-save to get the output
-    command = ['iptables-save']
+    command = iptables_dump_command
     log.debug('Running command: iptables-save')
     try:
         iptables_out = run_command(command, timeout_sec=20)
@@ -1103,15 +1662,232 @@ def save_iptables(rules_file='/etc/sysconfig/iptables'):
     if os.path.isfile(rules_file):
         time_now = datetime.now().strftime('%Y%m%d-%H%M%S')
         backup_file = '{f}.{d}'.format(f=rules_file, d=time_now)
-        log.debug('Creating backup file: {f}'.format(f=backup_file))
+        log.debug('Creating backup file: %s', backup_file)
         shutil.copy2(rules_file, backup_file)
 
     # Save the output to the rules file
-    log.debug('Creating file: {f}'.format(f=rules_file))
+    log.debug('Creating file: %s', rules_file)
     with open(rules_file, 'w') as f:
         f.write(iptables_out['output'])
 
 
+def _ssh_control_options():
+    """Returns the OpenSSH options pointing at the master sockets in a
+    private directory created for this process
+
+    :return: (list) ssh options
+    """
+    global _ssh_control_dir
+    with _ssh_control_lock:
+        if _ssh_control_dir is None:
+            _ssh_control_dir = tempfile.mkdtemp(prefix='pycons3rt-ssh-')
+    return ['-o', 'ControlPath={d}/%r@%h:%p'.format(d=_ssh_control_dir)]
+
+
+def _call_ssh(command, timeout_sec):
+    """Runs an ssh command with its stdio on /dev/null, killing it after
+    timeout_sec
+
+    :param command: (list) ssh command and args
+    :param timeout_sec: (float) seconds to wait before killing the command
+    :return: (int) exit code, None if ssh could not be run
+    """
+    try:
+        with open(os.devnull, 'r+') as devnull:
+            proc = subprocess.Popen(command, stdin=devnull, stdout=devnull, stderr=devnull)
+    except OSError:
+        return None
+    timer = Timer(timeout_sec, _kill_process, [proc])
+    timer.start()
+    try:
+        return proc.wait()
+    finally:
+        timer.cancel()
+
+
+def _start_ssh_master(host):
+    """Starts a background SSH master connection to the host unless one
+    is already running
+
+    The master is started with ssh -fN and its stdio on /dev/null, so it
+    never holds open a pipe that run_command waits on. A running master is
+    detected with ssh -O check so a second one is never started, and
+    ControlMaster=auto removes a stale socket left by a killed master. A
+    host whose master failed to start is not tried again.
+
+    :param host: (str) remote host
+    :return: None
+    """
+    if host in _ssh_master_failed_hosts:
+        return
+    with _ssh_control_lock:
+        host_lock = _ssh_control_locks.setdefault(host, Lock())
+    with host_lock:
+        if host in _ssh_master_failed_hosts:
+            return
+        if host in _ssh_control_hosts and \
+                _call_ssh(['ssh'] + _ssh_control_options() + ['-O', 'check', host], ssh_master_timeout_sec) == 0:
+            return
+        command = ['ssh', '-fN',
+                   '-o', 'ControlMaster=auto',
+                   '-o', 'ControlPersist={s}s'.format(s=ssh_control_persist_sec),
+                   '-o', 'BatchMode=yes',
+                   '-o', 'ConnectTimeout={s}'.format(s=max(1, int(ssh_master_timeout_sec)))] + \
+            _ssh_control_options() + ssh_options + [host]
+        if _call_ssh(command, ssh_master_timeout_sec) == 0:
+            _ssh_control_hosts.add(host)
+        else:
+            _ssh_master_failed_hosts.add(host)
+
+
+def _ssh_command(host, remote_command):
+    """Builds the command list to run a command on a remote host over
+    a shared SSH connection
+
+    The command only attaches to an existing master (ControlMaster=no) and
+    falls back to its own connection when there is none.
+
+    :param host: (str) remote host
+    :param remote_command: (str) command to run on the remote host
+    :return: (list) command to pass to run_command
+    """
+    _start_ssh_master(host)
+    return ['ssh', '-o', 'ControlMaster=no'] + _ssh_control_options() + ssh_options + [host, remote_command]
+
+
+def _paramiko_client(host, timeout_sec):
+    """Returns a connected paramiko client for the host, re-using the
+    connection from a previous call while it is active
+
+    :param host: (str) remote host, optionally as user@host
+    :param timeout_sec: (float) seconds to wait for a new connection
+    :return: (paramiko.SSHClient) connected client
+    :raises: paramiko.SSHException, socket.error
+    """
+    with _paramiko_clients_lock:
+        client = _paramiko_clients.get(host)
+    if client is not None:
+        transport = client.get_transport()
+        if transport is not None and transport.is_active():
+            return client
+    username, _, hostname = host.rpartition('@')
+    client = paramiko.SSHClient()
+    client.load_system_host_keys()
+    client.connect(hostname, username=username or None, timeout=timeout_sec)
+    with _paramiko_clients_lock:
+        existing = _paramiko_clients.get(host)
+        if existing is not None and existing.get_transport() is not None and existing.get_transport().is_active():
+            client.close()
+            return existing
+        _paramiko_clients[host] = client
+    return client
+
+
+def _run_ssh(host, remote_command, timeout_sec=5.0, input=None):
+    """Runs a command on a remote host over a shared SSH connection,
+    through paramiko when use_paramiko is set and it is installed,
+    otherwise with the ssh command
+
+    :param host: (str) remote host
+    :param remote_command: (str) command to run on the remote host
+    :param timeout_sec (float) seconds to wait before giving up on the
+        command.
+    :param input (str) data to send to the command on stdin
+    :return: (dict) containing the command output and return code, as
+        returned by run_command
+    :raises CommandError
+    """
+    if not use_paramiko or paramiko is None:
+        return run_command(_ssh_command(host, remote_command), timeout_sec=timeout_sec, input=input)
+    try:
+        channel = _paramiko_client(host, timeout_sec).get_transport().open_session()
+        try:
+            channel.settimeout(timeout_sec)
+            channel.set_combine_stderr(True)
+            channel.exec_command(remote_command)
+            if input is not None:
+                channel.sendall(input)
+            channel.shutdown_write()
+            output_buffer = bytearray()
+            while True:
+                chunk = channel.recv(65536)
+                if not chunk:
+                    break
+                output_buffer.extend(chunk)
+            code = channel.recv_exit_status()
+        finally:
+            channel.close()
+    except (paramiko.SSHException, socket.error):
+        _, ex, trace = sys.exc_info()
+        msg = 'There was a problem running command on host {h} with paramiko: {c}\n{e}'.format(
+            h=host, c=remote_command, e=str(ex))
+        raise CommandError, msg, trace
+    output = '\n'.join(line.rstrip() for line in str(output_buffer).split('\n')).strip()
+    return {
+        'output': output,
+        'code': code
+    }
+
+
+@atexit.register
+def _close_ssh_control_connections():
+    """Asks the SSH master connections opened by this process to exit
+    instead of lingering for ControlPersist, and closes any paramiko
+    connections
+
+    :return: None
+    """
+    with _paramiko_clients_lock:
+        for client in _paramiko_clients.values():
+            client.close()
+        _paramiko_clients.clear()
+    with open(os.devnull, 'w') as devnull:
+        for host in list(_ssh_control_hosts):
+            try:
+                subprocess.call(['ssh'] + _ssh_control_options() + ['-O', 'exit', host],
+                                stdin=devnull, stdout=devnull, stderr=devnull)
+            except OSError:
+                break
+    _ssh_control_hosts.clear()
+    if _ssh_control_dir is not None:
+        shutil.rmtree(_ssh_control_dir, ignore_errors=True)
+
+
+def _run_on_hosts(log, hosts, func, args, max_workers=32):
+    """Calls a remote host helper for several hosts concurrently
+
+    :param log: (logging.Logger) logger of the calling function
+    :param hosts: (list) hosts to pass as the first arg of func
+    :param func: remote host helper to call
+    :param args: (tuple) remaining args for func
+    :param max_workers: (int) maximum number of concurrent SSH sessions
+    :return: (dict) of host to the result of func, or the CommandError
+        raised for that host
+    :raises: TypeError
+    """
+    if not isinstance(hosts, list):
+        msg = 'hosts argument must be a list'
+        log.error(msg)
+        raise TypeError(msg)
+    for host in hosts:
+        _require_str(log, 'host', host)
+    if not hosts:
+        return {}
+
+    def run_on_host(host):
+        try:
+            return host, func(host, *args)
+        except CommandError as ex:
+            return host, ex
+
+    pool = ThreadPool(min(max_workers, len(hosts)))
+    try:
+        results = dict(pool.map(run_on_host, hosts))
+    finally:
+        pool.terminate()
+    return results
+
+
 def get_remote_host_environment_variable(host, environment_variable):
     """Retrieves the value of an environment variable of a
     remote host over SSH
@@ -1121,19 +1897,17 @@ def get_remote_host_environment_variable(host, environment_variable):
     :return: (str) value of the environment variable
     :raises: TypeError, CommandError
     """
-    log = logging.getLogger(mod_logger + '.get_remote_host_environment_variable')
-    if not isinstance(host, basestring):
-        msg = 'host argument must be a string'
-        log.error(msg)
-        raise TypeError(msg)
-    if not isinstance(environment_variable, basestring):
-        msg = 'environment_variable argument must be a string'
-        log.error(msg)
-        raise TypeError(msg)
-    log.info('Checking host {h} for environment variable: {v}...'.format(h=host, v=environment_variable))
-    command = ['ssh', '{h}'.format(h=host), 'echo ${v}'.format(v=environment_variable)]
+    log = _get_remote_host_environment_variable_log
+    _require_str(log, 'host', host)
+    _require_str(log, 'environment_variable', environment_variable)
+    with _remote_env_cache_lock:
+        cached = _remote_env_cache.get((host, environment_variable))
+    if cached is not None and time.time() - cached[1] < remote_env_cache_ttl_sec:
+        log.debug('Using recently read value of environment variable %s on host %s', environment_variable, host)
+        return cached[0]
+    log.info('Checking host %s for environment variable: %s...', host, environment_variable)
     try:
-        result = run_command(command, timeout_sec=5.0)
+        result = _run_ssh(host, 'echo ${v}'.format(v=environment_variable))
         code = result['code']
     except CommandError:
         raise
@@ -1144,11 +1918,29 @@ def get_remote_host_environment_variable(host, environment_variable):
         raise CommandError(msg)
     else:
         value = result['output'].strip()
-        log.info('Environment variable {e} on host {h} value is: {v}'.format(
-                e=environment_variable, h=host, v=value))
+        log.info('Environment variable %s on host %s value is: %s', environment_variable, host, value)
+    with _remote_env_cache_lock:
+        _remote_env_cache[(host, environment_variable)] = (value, time.time())
     return value
 
 
+def get_remote_host_environment_variable_many(hosts, environment_variable, max_workers=32):
+    """Retrieves the value of an environment variable from several
+    remote hosts over SSH concurrently
+
+    :param hosts: (list) hosts to query
+    :param environment_variable: (str) variable to query
+    :param max_workers: (int) maximum number of concurrent SSH sessions
+    :return: (dict) of host to the value of the environment variable,
+        or the CommandError raised for that host
+    :raises: TypeError
+    """
+    log = _get_remote_host_environment_variable_many_log
+    _require_str(log, 'environment_variable', environment_variable)
+    return _run_on_hosts(log, hosts, get_remote_host_environment_variable, (environment_variable,),
+                         max_workers=max_workers)
+
+
 def set_remote_host_environment_variable(host, variable_name, variable_value, env_file='/etc/bashrc'):
     """Sets an environment variable on the remote host in the
     specified environment file
@@ -1160,56 +1952,34 @@ def set_remote_host_environment_variable(host, variable_name, variable_value, en
     :return: None
     :raises: TypeError, CommandError
     """
-    log = logging.getLogger(mod_logger + '.set_remote_host_environment_variable')
-    if not isinstance(host, basestring):
-        msg = 'host argument must be a string'
-        log.error(msg)
-        raise TypeError(msg)
-    if not isinstance(variable_name, basestring):
-        msg = 'variable_name argument must be a string'
-        log.error(msg)
-        raise TypeError(msg)
-    if not isinstance(variable_value, basestring):
-        msg = 'variable_value argument must be a string'
-        log.error(msg)
-        raise TypeError(msg)
-    if not isinstance(env_file, basestring):
-        msg = 'env_file argument must be a string'
-        log.error(msg)
-        raise TypeError(msg)
-    log.info('Creating the environment file if it does not exist...')
-    command = ['ssh', host, 'touch {f}'.format(f=env_file)]
-    try:
-        result = run_command(command, timeout_sec=5.0)
-        code = result['code']
-        output = result['output']
-    except CommandError:
-        raise
-    if code != 0:
-        msg = 'There was a problem creating environment file {f} on remote host {h} over SSH, ' \
-              'exit code {c} and output:\n{o}'.format(h=host, c=code, f=env_file, o=output)
-        log.error(msg)
-        raise CommandError(msg)
+    log = _set_remote_host_environment_variable_log
+    _require_str(log, 'host', host)
+    _require_str(log, 'variable_name', variable_name)
+    _require_str(log, 'variable_value', variable_value)
+    _require_str(log, 'env_file', env_file)
+
+    export_line = 'export {v}="{n}"'.format(v=variable_name, n=variable_value)
+    quoted_env_file = pipes.quote(env_file)
 
-    log.info('Creating ensuring the environment file is executable...')
-    command = ['ssh', host, 'chmod +x {f}'.format(f=env_file)]
+    # Skip the write when env_file already has the exact export line, checked on the file rather than the cache
     try:
-        result = run_command(command, timeout_sec=5.0)
-        code = result['code']
-        output = result['output']
+        result = _run_ssh(host, 'grep -qsxF -- {l} {f}'.format(l=pipes.quote(export_line), f=quoted_env_file))
     except CommandError:
-        raise
-    if code != 0:
-        msg = 'There was a problem setting permissions on environment file {f} on remote host {h} over SSH, ' \
-              'exit code {c} and output:\n{o}'.format(h=host, c=code, f=env_file, o=output)
-        log.error(msg)
-        raise CommandError(msg)
+        result = None
+    if result is not None and result['code'] == 0:
+        log.info('Environment variable %s is already set to %s in file %s on host %s',
+                 variable_name, variable_value, env_file, host)
+        return
+
+    log.info('Adding environment variable %s with value %s to file %s...', variable_name, variable_value, env_file)
 
-    log.info('Adding environment variable {v} with value {n} to file {f}...'.format(
-            v=variable_name, n=variable_value, f=env_file))
-    command = ['ssh', host, 'echo "export {v}=\\"{n}\\"" >> {f}'.format(f=env_file, v=variable_name, n=variable_value)]
+    # Append the variable in a single SSH call, creating the file and making it executable if needed
+    # The export line is sent to tee on stdin so the value is never parsed by the remote shell
+    remote_command = 'tee -a {f} > /dev/null'.format(f=quoted_env_file)
+    if env_file not in well_known_env_files:
+        remote_command = 'touch {f} && chmod +x {f} && {c}'.format(f=quoted_env_file, c=remote_command)
     try:
-        result = run_command(command, timeout_sec=5.0)
+        result = _run_ssh(host, remote_command, input=export_line + '\n')
         code = result['code']
         output = result['output']
     except CommandError:
@@ -1220,7 +1990,9 @@ def set_remote_host_environment_variable(host, variable_name, variable_value, en
         log.error(msg)
         raise CommandError(msg)
     else:
-        log.info('Environment variable {v} set to {n} on host {h}'.format(v=variable_name, n=variable_value, h=host))
+        log.info('Environment variable %s set to %s on host %s', variable_name, variable_value, host)
+        with _remote_env_cache_lock:
+            _remote_env_cache.pop((host, variable_name), None)
 
 
 def run_remote_command(host, command, timeout_sec=5.0):
@@ -1233,28 +2005,22 @@ def run_remote_command(host, command, timeout_sec=5.0):
     :return: (str) command output
     :raises: TypeError, CommandError
     """
-    log = logging.getLogger(mod_logger + '.run_remote_command')
-    if not isinstance(host, basestring):
-        msg = 'host argument must be a string'
-        raise TypeError(msg)
-    if not isinstance(command, basestring):
-        msg = 'command argument must be a string'
-        raise TypeError(msg)
-    log.debug('Running remote command on host: {h}: {c}...'.format(h=host, c=command))
-    command = ['ssh', '{h}'.format(h=host), '{c}'.format(c=command)]
+    log = _run_remote_command_log
+    _require_str(log, 'host', host)
+    _require_str(log, 'command', command)
+    log.debug('Running remote command on host: %s: %s...', host, command)
     try:
-        result = run_command(command, timeout_sec=timeout_sec)
+        result = _run_ssh(host, command, timeout_sec=timeout_sec)
         code = result['code']
     except CommandError:
         raise
     if code != 0:
         msg = 'There was a problem running command [{m}] on host {h} over SSH, return code: {c}, and ' \
-              'produced output:\n{o}'.format(h=host, c=code, m=' '.join(command), o=result['output'])
+              'produced output:\n{o}'.format(h=host, c=code, m=command, o=result['output'])
         raise CommandError(msg)
     else:
         output_text = result['output'].strip()
-        log.debug('Running command [{m}] host {h} over SSH produced output: {o}'.format(
-            m=command, h=host, o=output_text))
+        log.debug('Running command [%s] host %s over SSH produced output: %s', command, host, output_text)
         output = {
             'output': output_text,
             'code': code
@@ -1262,6 +2028,59 @@ def run_remote_command(host, command, timeout_sec=5.0):
     return output
 
 
+def run_remote_commands(host, commands, stop_on_error=True, timeout_sec=5.0):
+    """Runs a sequence of commands on a remote host in a single SSH
+    call by sending them as a script to the remote shell on stdin
+
+    :param host: (str) host to run the commands on
+    :param commands: (list) of command strings, run in order
+    :param stop_on_error: (bool) True to stop at the first command that
+        fails, False to run them all and return the last exit code
+    :param timeout_sec (float) seconds to wait before killing the commands.
+    :return: (dict) containing the combined output and return code
+    :raises: TypeError, CommandError
+    """
+    log = _run_remote_commands_log
+    _require_str(log, 'host', host)
+    if not isinstance(commands, list):
+        msg = 'commands argument must be a list'
+        log.error(msg)
+        raise TypeError(msg)
+    for command in commands:
+        _require_str(log, 'command', command)
+    script = '\n'.join(commands) + '\n'
+    if stop_on_error:
+        script = 'set -e\n' + script
+    log.debug('Running %s remote commands on host %s:\n%s', len(commands), host, script)
+    try:
+        result = _run_ssh(host, 'sh -s', timeout_sec=timeout_sec, input=script)
+    except CommandError:
+        raise
+    if result['code'] != 0:
+        msg = 'There was a problem running commands on host {h} over SSH, return code: {c}, and ' \
+              'produced output:\n{o}'.format(h=host, c=result['code'], o=result['output'])
+        raise CommandError(msg)
+    log.debug('Running commands on host %s over SSH produced output: %s', host, result['output'])
+    return result
+
+
+def run_remote_command_many(hosts, command, timeout_sec=5.0, max_workers=32):
+    """Runs a command on several remote hosts over SSH concurrently
+
+    :param hosts: (list) hosts to run the command on
+    :param command: (str) command
+    :param timeout_sec (float) seconds to wait before killing the command.
+    :param max_workers: (int) maximum number of concurrent SSH sessions
+    :return: (dict) of host to the run_remote_command output dict, or
+        the CommandError raised for that host
+    :raises: TypeError
+    """
+    log = _run_remote_command_many_log
+    _require_str(log, 'command', command)
+    log.debug('Running remote command on hosts %s: %s...', hosts, command)
+    return _run_on_hosts(log, hosts, run_remote_command, (command, timeout_sec), max_workers=max_workers)
+
+
 def check_remote_host_marker_file(host, file_path):
     """Queries a remote host over SSH to check for existence
     of a marker file
@@ -1271,28 +2090,29 @@ def check_remote_host_marker_file(host, file_path):
     :return: (bool) True if the marker file exists
     :raises: TypeError, CommandError
     """
-    log = logging.getLogger(mod_logger + '.check_remote_host_marker_file')
-    if not isinstance(host, basestring):
-        msg = 'host argument must be a string'
-        log.error(msg)
-        raise TypeError(msg)
-    if not isinstance(file_path, basestring):
-        msg = 'file_path argument must be a string'
-        log.error(msg)
-        raise TypeError(msg)
-    log.debug('Checking host {h} for marker file: {f}...'.format(h=host, f=file_path))
-    command = ['ssh', '{h}'.format(h=host), 'if [ -f {f} ] ; then exit 0 ; else exit 1 ; fi'.format(f=file_path)]
+    log = _check_remote_host_marker_file_log
+    _require_str(log, 'host', host)
+    _require_str(log, 'file_path', file_path)
+    # Marker files are not removed, a recent positive result can be re-used
+    with _marker_file_cache_lock:
+        found_time = _marker_file_cache.get((host, file_path))
+    if found_time is not None and time.time() - found_time < marker_file_cache_ttl_sec:
+        log.debug('Marker file <%s> was recently found on host %s', file_path, host)
+        return True
+    log.debug('Checking host %s for marker file: %s...', host, file_path)
     try:
-        result = run_command(command, timeout_sec=5.0)
+        result = _run_ssh(host, 'test -f {f}'.format(f=pipes.quote(file_path)))
         code = result['code']
         output = result['output']
     except CommandError:
         raise
     if code == 0:
-        log.debug('Marker file <{f}> was found on host {h}'.format(f=file_path, h=host))
+        log.debug('Marker file <%s> was found on host %s', file_path, host)
+        with _marker_file_cache_lock:
+            _marker_file_cache[(host, file_path)] = time.time()
         return True
     elif code == 1 and output == '':
-        log.debug('Marker file <{f}> was not found on host {h}'.format(f=file_path, h=host))
+        log.debug('Marker file <%s> was not found on host %s', file_path, host)
         return False
     else:
         msg = 'There was a problem checking the remote host {h} over SSH for marker file {f}, ' \
@@ -1302,6 +2122,64 @@ def check_remote_host_marker_file(host, file_path):
         raise CommandError(msg)
 
 
+def check_remote_host_marker_file_many(hosts, file_path, max_workers=32):
+    """Queries several remote hosts over SSH concurrently to check
+    for existence of a marker file
+
+    :param hosts: (list) hosts to query
+    :param file_path: (str) path to the marker file
+    :param max_workers: (int) maximum number of concurrent SSH sessions
+    :return: (dict) of host to True if the marker file exists, or the
+        CommandError raised for that host
+    :raises: TypeError
+    """
+    log = _check_remote_host_marker_file_many_log
+    _require_str(log, 'file_path', file_path)
+    return _run_on_hosts(log, hosts, check_remote_host_marker_file, (file_path,), max_workers=max_workers)
+
+
+def check_remote_host_marker_files(host, file_paths):
+    """Queries a remote host over SSH to check for existence
+    of several marker files in a single SSH call
+
+    :param host: (str) host to query
+    :param file_paths: (list) paths to the marker files
+    :return: (dict) of file path to True if the marker file exists
+    :raises: TypeError, CommandError
+    """
+    log = _check_remote_host_marker_files_log
+    _require_str(log, 'host', host)
+    if not isinstance(file_paths, list):
+        msg = 'file_paths argument must be a list'
+        log.error(msg)
+        raise TypeError(msg)
+    for file_path in file_paths:
+        _require_str(log, 'file_path', file_path)
+    if not file_paths:
+        return {}
+    log.debug('Checking host %s for marker files: %s...', host, ', '.join(file_paths))
+    remote_command = 'for f in {p} ; do if [ -f "$f" ] ; then echo Y ; else echo N ; fi ; done'.format(
+        p=' '.join(pipes.quote(file_path) for file_path in file_paths))
+    try:
+        result = _run_ssh(host, remote_command)
+    except CommandError:
+        raise
+    answers = [line.strip() for line in result['output'].splitlines() if line.strip() in ['Y', 'N']]
+    if result['code'] != 0 or len(answers) != len(file_paths):
+        msg = 'There was a problem checking the remote host {h} over SSH for marker files, ' \
+              'command returned code {c} and produced output: {o}'.format(
+                h=host, c=result['code'], o=result['output'])
+        log.debug(msg)
+        raise CommandError(msg)
+    markers = dict(zip(file_paths, [answer == 'Y' for answer in answers]))
+    now = time.time()
+    with _marker_file_cache_lock:
+        for file_path, found in markers.items():
+            if found:
+                _marker_file_cache[(host, file_path)] = now
+    return markers
+
+
 def create_remote_host_marker_file(host, file_path):
     """Creates a marker file on a remote host
 
@@ -1310,25 +2188,20 @@ def create_remote_host_marker_file(host, file_path):
     :return: None
     :raises: TypeError, CommandError
     """
-    log = logging.getLogger(mod_logger + '.create_remote_host_marker_file')
-    if not isinstance(host, basestring):
-        msg = 'host argument must be a string'
-        log.error(msg)
-        raise TypeError(msg)
-    if not isinstance(file_path, basestring):
-        msg = 'file_path argument must be a string'
-        log.error(msg)
-        raise TypeError(msg)
-    log.debug('Attempting to create marker file {f} on host: {h}...'.format(f=file_path, h=host))
-    command = ['ssh', '{h}'.format(h=host), 'touch {f}'.format(f=file_path)]
+    log = _create_remote_host_marker_file_log
+    _require_str(log, 'host', host)
+    _require_str(log, 'file_path', file_path)
+    log.debug('Attempting to create marker file %s on host: %s...', file_path, host)
     try:
-        result = run_command(command, timeout_sec=5.0)
+        result = _run_ssh(host, 'touch {f}'.format(f=pipes.quote(file_path)))
         code = result['code']
         output = result['output']
     except CommandError:
         raise
     if code == 0:
-        log.info('Marker file {f} successfully created on host {h}'.format(f=file_path, h=host))
+        log.info('Marker file %s successfully created on host %s', file_path, host)
+        with _marker_file_cache_lock:
+            _marker_file_cache[(host, file_path)] = time.time()
     else:
         msg = 'There was a problem creating marker file {f} on remote host {h} over SSH, command returned code {c} ' \
               'and produced output: {o}'.format(h=host, f=file_path, c=code, o=output)
@@ -1336,37 +2209,74 @@ def create_remote_host_marker_file(host, file_path):
         raise CommandError(msg)
 
 
-def restore_iptables(firewall_rules):
-    """Restores and saves firewall rules from the firewall_rules file
+def create_remote_host_marker_file_many(hosts, file_path, max_workers=32):
+    """Creates a marker file on several remote hosts over SSH
+    concurrently
+
+    :param hosts: (list) hosts to create the file on
+    :param file_path: (str) Full path for the file to create
+    :param max_workers: (int) maximum number of concurrent SSH sessions
+    :return: (dict) of host to None, or the CommandError raised for
+        that host
+    :raises: TypeError
+    """
+    log = _create_remote_host_marker_file_many_log
+    _require_str(log, 'file_path', file_path)
+    return _run_on_hosts(log, hosts, create_remote_host_marker_file, (file_path,), max_workers=max_workers)
+
+
+def restore_iptables(firewall_rules=None, check_exists=True, rules_text=None):
+    """Restores and saves firewall rules from the firewall_rules file,
+    or from rules_text
 
     :param firewall_rules: (str) Full path to the firewall rules file
+    :param check_exists: (bool) True to ensure firewall_rules is a file
+        before running iptables-restore, False to skip the check for
+        known files
+    :param rules_text: (str) firewall rules in iptables-save format to
+        pass to iptables-restore on stdin instead of a file
     :return: None
     :raises OSError
     """
-    log = logging.getLogger(mod_logger + '.restore_iptables')
-    log.info('Restoring firewall rules from file: {f}'.format(f=firewall_rules))
-
-    # Ensure the firewall rules file exists
-    if not os.path.isfile(firewall_rules):
-        msg = 'Unable to restore iptables, file not found: {f}'.format(f=firewall_rules)
+    log = _restore_iptables_log
+    if rules_text is not None:
+        log.info('Restoring firewall rules from the provided rules text')
+        source = 'the provided rules text'
+        command = ['/sbin/iptables-restore']
+    elif firewall_rules is None:
+        msg = 'Either firewall_rules or rules_text must be provided'
         log.error(msg)
         raise OSError(msg)
+    else:
+        log.info('Restoring firewall rules from file: %s', firewall_rules)
+
+        # Ensure the firewall rules file exists
+        if check_exists:
+            try:
+                is_file = stat.S_ISREG(os.stat(firewall_rules).st_mode)
+            except OSError:
+                is_file = False
+            if not is_file:
+                msg = 'Unable to restore iptables, file not found: {f}'.format(f=firewall_rules)
+                log.error(msg)
+                raise OSError(msg)
+        source = 'file: {f}'.format(f=firewall_rules)
+        command = ['/sbin/iptables-restore', firewall_rules]
 
     # Restore the firewall rules
-    log.info('Restoring iptables from file: {f}'.format(f=firewall_rules))
-    command = ['/sbin/iptables-restore', firewall_rules]
+    log.info('Restoring iptables from %s', source)
     try:
-        result = run_command(command)
+        result = run_command(command, input=rules_text)
     except CommandError:
         _, ex, trace = sys.exc_info()
-        msg = 'Unable to restore firewall rules from file: {f}\n{e}'.format(f=firewall_rules, e=str(ex))
+        msg = 'Unable to restore firewall rules from {s}\n{e}'.format(s=source, e=str(ex))
         log.error(msg)
         raise OSError(msg)
-    log.info('Restoring iptables produced output:\n{o}'.format(o=result['output']))
+    log.info('Restoring iptables produced output:\n%s', result['output'])
 
     # Save iptables
     log.info('Saving iptables...')
-    command = ['/etc/init.d/iptables', 'save']
+    command = iptables_save_command
     try:
         result = run_command(command)
     except CommandError:
@@ -1374,7 +2284,7 @@ def restore_iptables(firewall_rules):
         msg = 'Unable to save firewall rules\n{e}'.format(e=str(ex))
         log.error(msg)
         raise OSError(msg)
-    log.info('Saving iptables produced output:\n{o}'.format(o=result['output']))
+    log.info('Saving iptables produced output:\n%s', result['output'])
 
 
 def remove_default_gateway():
@@ -1386,23 +2296,24 @@ def remove_default_gateway():
     """
     log = logging.getLogger(mod_logger + '.remove_default_gateway')
 
-    # Ensure the network script exists
+    # Read the network script if it exists
     network_script = '/etc/sysconfig/network'
-    if not os.path.isfile(network_script):
-        log.info('Network script not found, nothing to do: {f}'.format(f=network_script))
+    try:
+        with open(network_script, 'r') as f:
+            lines = f.readlines()
+    except(IOError, OSError):
+        _, ex, trace = sys.exc_info()
+        if ex.errno != errno.ENOENT:
+            raise
+        log.info('Network script not found, nothing to do: %s', network_script)
         return
-    log.debug('Found network script: {f}'.format(f=network_script))
+    log.debug('Found network script: %s', network_script)
 
     # Remove settings for GATEWAY and GATEWAYDEV
     log.info('Attempting to remove any default gateway configurations...')
-    for line in fileinput.input(network_script, inplace=True):
-        if re.search('^GATEWAY=.*', line):
-            log.info('Removing GATEWAY line: {li}'.format(li=line))
-        elif re.search('^GATEWAYDEV=.*', line):
-            log.info('Removing GATEWAYDEV line: {li}'.format(li=line))
-        else:
-            log.debug('Keeping line: {li}'.format(li=line))
-            sys.stdout.write(line)
+    kept_lines = [line for line in lines if not line.startswith(('GATEWAY=', 'GATEWAYDEV='))]
+    _write_file_atomic(network_script, ''.join(kept_lines))
+    log.info('Removed %s GATEWAY and GATEWAYDEV lines from: %s', len(lines) - len(kept_lines), network_script)
 
     # Restart networking for the changes to take effect
     log.info('Restarting the network service...')
@@ -1419,8 +2330,14 @@ def remove_default_gateway():
 def is_systemd():
     """Determines whether this system uses systemd
 
+    The distro is only inspected once per process, the result is
+    cached for subsequent calls.
+
     :return: (bool) True if this distro has systemd
     """
+    global _is_systemd_cached
+    if _is_systemd_cached is not None:
+        return _is_systemd_cached
     os_family = platform.system()
     if os_family != 'Linux':
         raise OSError('This method is only supported on Linux, found OS: {o}'.format(o=os_family))
@@ -1434,28 +2351,27 @@ def is_systemd():
         systemd = True
     elif 'cent' in linux_distro.lower() and '7' in linux_version:
         systemd = True
+    _is_systemd_cached = systemd
     return systemd
 
 
-def manage_service(service_name, service_action='status', systemd=None, output=True):
+def manage_service(service_name, service_action='status', systemd=None, output=True, settle_sec=0):
     """Use to run Linux sysv or systemd service commands
 
     :param service_name (str) name of the service to start
     :param service_action (str) action to perform on the service
     :param systemd (bool) True if the command should use systemd
     :param output (bool) True to print output
+    :param settle_sec (float) additional seconds to wait after each
+        command, legacy behavior was 3
     :return: None
     :raises: OSError
     """
     log = logging.getLogger(mod_logger + '.manage_service')
 
-    # Ensure the service name is a string
-    if not isinstance(service_name, basestring):
-        raise OSError('service_name arg must be a string, found: {t}'.format(t=service_name.__class__.__name__))
-
-    # Ensure the service name is a string
-    if not isinstance(service_action, basestring):
-        raise OSError('service_action arg must be a string, found: {t}'.format(t=service_name.__class__.__name__))
+    # Ensure the service name and action are strings
+    _require_str(log, 'service_name', service_name, error=OSError)
+    _require_str(log, 'service_action', service_action, error=OSError)
 
     # Ensure the service action is valid
     valid_actions = ['start', 'stop', 'reload', 'restart', 'status', 'enable', 'disable']
@@ -1467,7 +2383,7 @@ def manage_service(service_name, service_action='status', systemd=None, output=T
     log.info('Attempting to [{a}] service: {s}'.format(a=service_action, s=service_name))
 
     # If systemd was not provided, attempt to determine which method to use
-    if not systemd:
+    if systemd is None:
         log.debug('Systemd not provided, attempting to determine which method to use...')
         systemd = is_systemd()
 
@@ -1491,7 +2407,6 @@ def manage_service(service_name, service_action='status', systemd=None, output=T
             command_list.append(['/sbin/service', service_name, service_action])
 
     # Run the commands in the command list
-    post_command_wait_time_sec = 3
     for command in command_list:
         log.info('Attempting to run command: [{c}]'.format(c=' '.join(command)))
         try:
@@ -1507,16 +2422,29 @@ def manage_service(service_name, service_action='status', systemd=None, output=T
             raise OSError(msg)
         else:
             log.info('Command returned successfully with output:\n{o}'.format(o=result['output']))
-        log.info('Waiting {t} sec...'.format(t=str(post_command_wait_time_sec)))
-        time.sleep(post_command_wait_time_sec)
+        if settle_sec:
+            time.sleep(settle_sec)
+
+    # Wait for state changing actions to take effect
+    if service_action in ['start', 'restart', 'reload', 'stop']:
+        if systemd:
+            status_command = ['/usr/bin/systemctl', 'is-active', '--quiet', service_name]
+        else:
+            status_command = ['/sbin/service', service_name, 'status']
+        log.info('Waiting for service {s} to finish [{a}]...'.format(s=service_name, a=service_action))
+        if not _wait_for_service_state(status_command, active=service_action != 'stop'):
+            log.warn('Service {s} did not reach the expected state after [{a}]'.format(
+                s=service_name, a=service_action))
 
 
-def system_reboot(wait_time_sec=20):
+def system_reboot(wait_time_sec=20, settle_sec=0):
     """Reboots the system after a specified wait time.  Must be run as root
 
     :param wait_time_sec: (int) number of sec to wait before performing the reboot
+    :param settle_sec: (float) additional seconds to wait just before
+        running shutdown, legacy behavior was 2
     :return: None
-    :raises: SystemRebootError, SystemRebootTimeoutError
+    :raises: SystemRebootError
     """
     log = logging.getLogger(mod_logger + '.system_reboot')
 
@@ -1529,7 +2457,8 @@ def system_reboot(wait_time_sec=20):
     time.sleep(wait_time_sec)
     command = ['shutdown', '-r', 'now']
     log.info('Shutting down with command: [{c}]'.format(c=' '.join(command)))
-    time.sleep(2)
+    if settle_sec:
+        time.sleep(settle_sec)
     log.info('Shutting down...')
     try:
         result = run_command(command=command, timeout_sec=60)
@@ -1541,11 +2470,7 @@ def system_reboot(wait_time_sec=20):
         msg = 'Shutdown command exited with a non-zero code: [{c}], and produced output:\n{o}'.format(
             c=str(result['code']), o=result['output'])
         raise SystemRebootError(msg)
-    log.info('Waiting 60 seconds to ensure the reboot completes...')
-    time.sleep(60)
-    msg = 'Reboot has not completed after 60 seconds'
-    log.error(msg)
-    raise SystemRebootTimeoutError(msg)
+    log.info('Reboot initiated successfully')
 
 
 def main():